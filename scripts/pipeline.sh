@@ -92,7 +92,8 @@ function build_db() {
     env "PYTHONPATH=src" \
     pipenv run python3 'src/pipeline/build-db/run.py' \
         --data-path "$wikipedia_path" \
-        --save-path "$db_file"
+        --save-path "$db_file" \
+        --bulk-load
   fi
 }
 
@@ -235,49 +236,34 @@ function sentence_retrieval() {
     local sent_ret_file="$sent_ret_path/sentences.predicted.$filetype.jsonl"
     local doc_ret_file="$doc_ret_path/documents.predicted.$filetype.jsonl"
 
-    local sent_score_file="$sent_ret_path/sentences.scored.$filetype.tsv"
     local sent_file="$sent_ret_path/sentences.all.$filetype.tsv"
-    local score_file="$sent_ret_path/sentences.score.$filetype.tsv"
 
     if [ ! -f "$sent_ret_file" ]; then
-      if [ ! -f "$sent_score_file" ]; then
-        if [ ! -f "$sent_file" ]; then
-          echo "● Generating sentences to score from retrieved documents for claims in $doc_ret_file..."
-          env "PYTHONPATH=src" \
-          pipenv run python3 'src/pipeline/sentence-retrieval/generate.py' \
-              --prediction \
-              --db-file "$db_file" \
-              --in-file "$doc_ret_file" \
-              --out-file "$sent_file"
-        fi
-
-        if [ ! -f "$score_file" ]; then
-          echo "● Scoring sentences from retrieved documents for claims in $sent_file..."
-          env "PYTHONPATH=src" \
-          pipenv run python3 'src/pipeline/sentence-retrieval/model.py' \
-              --model_type "$model_type" \
-              --model_name_or_path "$model_name" \
-              --max_seq_length 128 \
-              --task_name 'sentence_retrieval' \
-              --output_dir "$model_path" \
-              --cache_dir "$transformers_cache_path" \
-              --do_predict \
-              --predict_in_file "$sent_file" \
-              --predict_out_file "$score_file" \
-              --per_gpu_predict_batch_size=32
-        fi
-
-        echo "● Combining $sent_file and $score_file in $sent_score_file..."
-        paste -d'\t' "$sent_file" "$score_file" > "$sent_score_file"
+      if [ ! -f "$sent_file" ]; then
+        echo "● Generating sentences to score from retrieved documents for claims in $doc_ret_file..."
+        env "PYTHONPATH=src" \
+        pipenv run python3 'src/pipeline/sentence-retrieval/generate.py' \
+            --prediction \
+            --db-file "$db_file" \
+            --in-file "$doc_ret_file" \
+            --out-file "$sent_file"
       fi
 
-      echo "● Retrieving the top $max_sentences_per_claim evidence sentences for each claim in $dataset_file..."
+      echo "● Scoring sentences in $sent_file and retrieving the top $max_sentences_per_claim evidence sentences for each claim in $dataset_file..."
       env "PYTHONPATH=src" \
-      pipenv run python3 'src/pipeline/sentence-retrieval/run.py' \
-          --scores-file "$sent_score_file" \
-          --in-file "$dataset_file" \
-          --out-file "$sent_ret_file" \
-          --max-sentences-per-claim $max_sentences_per_claim
+      pipenv run python3 'src/pipeline/sentence-retrieval/model.py' \
+          --model_type "$model_type" \
+          --model_name_or_path "$model_name" \
+          --max_seq_length 128 \
+          --task_name 'sentence_retrieval' \
+          --output_dir "$model_path" \
+          --cache_dir "$transformers_cache_path" \
+          --do_predict \
+          --predict_in_file "$sent_file" \
+          --predict_claims_file "$dataset_file" \
+          --predict_out_file "$sent_ret_file" \
+          --max_sentences_per_claim $max_sentences_per_claim \
+          --per_gpu_predict_batch_size=32
     fi
   done
 
@@ -0,0 +1,67 @@
+"""Key-value cache, in a sqlite database."""
+
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class PersistentCache(object):
+    """Sqlite backed cache of JSON serializable values.
+
+    The most recently used entries are also kept in memory, up to 'capacity'
+    entries, evicting the least recently used one first.
+    """
+
+    def __init__(self, path, capacity=100000):
+        self.path = path
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=60
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the connection to the database."""
+        self.connection.close()
+
+    def get(self, key, default=None):
+        """Return the value stored for 'key', or 'default' if there is none."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            result = self.connection.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,),
+            ).fetchone()
+            if result is None:
+                return default
+            value = json.loads(result[0])
+            self.remember(key, value)
+            return value
+
+    def put(self, key, value):
+        """Store 'value' for 'key', replacing any previous value."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?)", (key, json.dumps(value)),
+            )
+            self.remember(key, value)
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
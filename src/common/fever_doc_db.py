@@ -6,16 +6,242 @@
 # https://github.com/sheffieldnlp/fever-naacl-2018/blob/master/LICENSE
 """Documents, in a sqlite database."""
 
+import bisect
+import functools
+import json
+import logging
+import os
+import re
 import sqlite3
+import sys
+import tempfile
+import threading
 import unicodedata
+import zlib
+from array import array
+from collections import OrderedDict
+from urllib.request import pathname2url
+
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = ["zlib", "zstd"]
+
+MISSING = object()
+
+
+def split_doc_lines(lines):
+    """Split the raw text of a doc in a list of (sentence id, sentence text)
+    pairs, one for each of its lines. The text is None for malformed lines."""
+    sentences = []
+    for line in re.split("\n(?=\\d+)", lines):
+        fields = line.split("\t")
+        sentences.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return sentences
+
+
+class DocCompressor(object):
+    """Compress and decompress the lines of the docs stored in the db."""
+
+    def __init__(self, compression, dictionary=None, level=None):
+        if compression not in COMPRESSIONS:
+            raise KeyError(compression)
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("Please install zstandard from https://github.com/indygreg/python-zstandard to use zstd compression.")
+            self.zstandard = zstandard
+        self.compression = compression
+        self.dictionary = dictionary
+        self.level = level
+        self.local = threading.local()
+
+    @staticmethod
+    def train_dictionary(samples, dict_size):
+        """Train a zstd dictionary of 'dict_size' bytes from the lines of some docs."""
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Please install zstandard from https://github.com/indygreg/python-zstandard to use zstd compression.")
+        samples = [lines.encode("utf-8") for lines in samples]
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+    def compress(self, lines):
+        data = lines.encode("utf-8")
+        if self.compression == "zlib":
+            return zlib.compress(data, 6 if self.level is None else self.level)
+        # zstd (de)compressors must not be shared between threads.
+        if not hasattr(self.local, "compressor"):
+            self.local.compressor = self.zstandard.ZstdCompressor(
+                level=3 if self.level is None else self.level,
+                dict_data=self.get_zstd_dictionary(),
+            )
+        return self.local.compressor.compress(data)
+
+    def decompress(self, data):
+        if self.compression == "zlib":
+            return zlib.decompress(data).decode("utf-8")
+        if not hasattr(self.local, "decompressor"):
+            self.local.decompressor = self.zstandard.ZstdDecompressor(
+                dict_data=self.get_zstd_dictionary(),
+            )
+        return self.local.decompressor.decompress(data).decode("utf-8")
+
+    def get_zstd_dictionary(self):
+        if self.dictionary is None:
+            return None
+        return self.zstandard.ZstdCompressionDict(self.dictionary)
+
+
+def get_db_signature(db_path):
+    """Return the size and modification time of the db file at 'db_path',
+    stored in the files derived from the db to detect that they are stale."""
+    stat = os.stat(db_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class SortedTitles(object):
+    """Sorted array of doc ids, stored as a single blob of utf-8 encoded ids
+    each terminated by a newline, plus the offset at which each id starts.
+
+    When saved, the blob is preceded by a header line with the signature of
+    the db the ids come from (see 'get_db_signature').
+    """
+
+    header = b"\x00fever-ids "
+
+    def __init__(self, blob, signature=None):
+        self.blob = blob
+        self.signature = signature
+        self.offsets = array("Q")
+        start = 0
+        while start < len(blob):
+            self.offsets.append(start)
+            start = blob.index(b"\n", start) + 1
+        self.offsets.append(len(blob))
+
+    @classmethod
+    def build(cls, doc_ids, signature=None):
+        """Build the array from the (NFD normalized) ids in 'doc_ids'."""
+        ids = sorted(doc_id.encode("utf-8") for doc_id in doc_ids)
+        return cls(b"".join(doc_id + b"\n" for doc_id in ids), signature)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        # Files saved without a header have no signature.
+        if not data.startswith(cls.header):
+            return cls(data)
+        header, blob = data.split(b"\n", 1)
+        return cls(blob, json.loads(header[len(cls.header) :].decode("utf-8")))
+
+    def save(self, path):
+        # Write aside to a file of its own, in case of concurrent saves.
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), delete=False) as f:
+            f.write(self.header + json.dumps(self.signature).encode("utf-8") + b"\n")
+            f.write(self.blob)
+        os.replace(f.name, path)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i] : self.offsets[i + 1] - 1]
+
+    def __contains__(self, doc_id):
+        doc_id = doc_id.encode("utf-8")
+        i = bisect.bisect_left(self, doc_id)
+        return i < len(self) and self[i] == doc_id
+
+
+class DocCache(object):
+    """LRU cache of doc contents, bounded by the (estimated) size in bytes of
+    the cached values."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size and self.entries:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def info(self):
+        """Return the hit, miss and eviction counters and the size of the cache."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size,
+            }
+
+
+def sizeof_lines(lines):
+    return sys.getsizeof(lines)
+
+
+def sizeof_sentences(sentences):
+    return sys.getsizeof(sentences) + sum(
+        sys.getsizeof(sentence) + sys.getsizeof(sentence[0]) + sys.getsizeof(sentence[1])
+        for sentence in sentences
+    )
 
 
 class FeverDocDB(object):
-    """Sqlite backed document storage."""
+    """Sqlite backed document storage.
+
+    In read-only mode the db is opened as immutable and memory-mapped, and each
+    thread reads from it through its own connection.
+    """
+
+    # Number of ids looked up by a single query.
+    batch_size = 900
+    # Number of ids above which they are looked up through a temporary table.
+    join_threshold = 10000
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, title_index=False, cache_size=0, read_only=False, mmap_size=2 ** 40):
         self.path = db_path
-        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.connections = []
+        # Reentrant, since loading the titles may open a connection.
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.shared_connection = None if self.read_only else self.connect()
+        self.title_index = title_index
+        self.titles = None
+        self.cache = DocCache(cache_size) if cache_size > 0 else None
+        self.has_sentences = self.has_table("sentences")
+        self.compressor = None
+        compression = self.get_metadata("compression")
+        if compression is not None:
+            self.compressor = DocCompressor(compression, self.get_metadata("compression_dict"))
 
     def __enter__(self):
         return self
@@ -27,9 +253,63 @@ class FeverDocDB(object):
         """Return the path to the file that backs this database."""
         return self.path
 
+    @property
+    def connection(self):
+        """Return the connection to the database to use in the calling thread."""
+        if not self.read_only:
+            return self.shared_connection
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+
+    def connect(self):
+        connection = self.open_connection()
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def open_connection(self):
+        if not self.read_only:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+        else:
+            # SQLite caps 'mmap_size' to the maximum it was compiled with.
+            uri = "file:%s?mode=ro&immutable=1" % pathname2url(os.path.abspath(self.path))
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            connection.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+        return connection
+
     def close(self):
-        """Close the connection to the database."""
-        self.connection.close()
+        """Close the connections to the database."""
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+    def has_table(self, name):
+        """Check whether the db contains the table 'name'."""
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,),
+        )
+        result = cursor.fetchone()
+        cursor.close()
+        return result is not None
+
+    def get_metadata(self, key):
+        """Fetch the value of 'key' in the metadata of the db, if any."""
+        if not self.has_table("metadata"):
+            return None
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT value FROM metadata WHERE key = ?", (key,))
+        result = cursor.fetchone()
+        cursor.close()
+        return result if result is None else result[0]
+
+    def decode_lines(self, lines):
+        if lines is None or self.compressor is None:
+            return lines
+        return self.compressor.decompress(lines)
 
     def get_doc_ids(self):
         """Fetch all ids of docs stored in the db."""
@@ -39,25 +319,153 @@ class FeverDocDB(object):
         cursor.close()
         return results
 
-    def get_doc_lines(self, doc_id):
-        """Fetch the raw text of the doc for 'doc_id'."""
-        cursor = self.connection.cursor()
+    def get_titles(self):
+        """Return the sorted ids of the docs stored in the db.
+
+        The ids are loaded from the file next to the db, which is created the
+        first time they are requested, by a single thread, and rebuilt when it
+        does not match the db anymore.
+        """
+        if self.titles is None:
+            with self.lock:
+                if self.titles is None:
+                    titles_path = os.path.splitext(self.path)[0] + ".ids"
+                    signature = get_db_signature(self.path)
+                    titles = SortedTitles.load(titles_path) if os.path.isfile(titles_path) else None
+                    if titles is not None and titles.signature != signature:
+                        logger.warning("%s does not match %s, rebuilding it", titles_path, self.path)
+                        titles = None
+                    if titles is None:
+                        titles = SortedTitles.build(self.get_doc_ids(), signature)
+                        titles.save(titles_path)
+                    self.titles = titles
+        return self.titles
+
+    def has_doc(self, doc_id):
+        """Check whether the doc for 'doc_id' exists, without fetching it."""
         norm_id = unicodedata.normalize("NFD", doc_id)
+        if self.title_index:
+            return norm_id in self.get_titles()
+        cursor = self.connection.cursor()
         cursor.execute(
-            "SELECT lines FROM documents WHERE id = ?", (norm_id,),
+            "SELECT 1 FROM documents WHERE id = ?", (norm_id,),
         )
         result = cursor.fetchone()
         cursor.close()
-        return result if result is None else result[0]
+        return result is not None
+
+    def get_doc_lines(self, doc_id):
+        """Fetch the raw text of the doc for 'doc_id'."""
+        results = self.get_all_doc_lines([doc_id])
+        return None if len(results) == 0 else results[0][1]
 
     def get_all_doc_lines(self, doc_ids):
         """Fetch the raw text of the docs in 'doc_ids'."""
-        cursor = self.connection.cursor()
-        placeholders = ",".join(["?"] * len(doc_ids))
+        return list(self.iter_doc_lines(doc_ids))
+
+    def get_all_doc_sentences(self, doc_ids):
+        """Fetch the sentences of the docs in 'doc_ids', as (id, sentences)
+        pairs where sentences is a list of (sentence id, sentence text)."""
+        return list(self.iter_doc_sentences(doc_ids))
+
+    def iter_doc_lines(self, doc_ids, batch_size=None, join_threshold=None):
+        """Fetch the raw text of the docs in 'doc_ids', yielding (id, lines)
+        pairs as they are read.
+
+        The ids are looked up 'batch_size' at a time, or all at once through a
+        temporary table when there are more than 'join_threshold' of them.
+        """
         norm_ids = [unicodedata.normalize("NFD", doc_id) for doc_id in doc_ids]
-        cursor.execute(
-            "SELECT id,lines FROM documents WHERE id IN (%s)" % placeholders, norm_ids,
+        fetch = functools.partial(self.fetch_doc_lines, batch_size=batch_size, join_threshold=join_threshold)
+        return self.iter_cached("lines", norm_ids, fetch, sizeof_lines)
+
+    def iter_doc_sentences(self, doc_ids, batch_size=None, join_threshold=None):
+        """Fetch the sentences of the docs in 'doc_ids', yielding (id,
+        sentences) pairs as they are read. See 'iter_doc_lines'."""
+        norm_ids = [unicodedata.normalize("NFD", doc_id) for doc_id in doc_ids]
+        fetch = functools.partial(self.fetch_doc_sentences, batch_size=batch_size, join_threshold=join_threshold)
+        return self.iter_cached("sentences", norm_ids, fetch, sizeof_sentences)
+
+    def cache_info(self):
+        """Return the counters of the cache, or None if caching is disabled."""
+        return None if self.cache is None else self.cache.info()
+
+    def iter_cached(self, kind, norm_ids, fetch, sizeof):
+        norm_ids = list(dict.fromkeys(norm_ids))
+        if self.cache is None:
+            yield from fetch(norm_ids)
+            return
+        missing = []
+        for norm_id in norm_ids:
+            value = self.cache.get((kind, norm_id), MISSING)
+            if value is MISSING:
+                missing.append(norm_id)
+            elif value is not None:
+                yield norm_id, value
+        if len(missing) == 0:
+            return
+        found = set()
+        for norm_id, value in fetch(missing):
+            found.add(norm_id)
+            self.cache.put((kind, norm_id), value, sys.getsizeof(norm_id) + sizeof(value))
+            yield norm_id, value
+        for norm_id in missing:
+            # Also remember the docs that do not exist.
+            if norm_id not in found:
+                self.cache.put((kind, norm_id), None, sys.getsizeof(norm_id))
+
+    def query_ids(self, query, norm_ids, batch_size=None, join_threshold=None):
+        """Run 'query' for the distinct ids in 'norm_ids', yielding its rows.
+
+        The query selects the ids with a "IN (%s)" placeholder, which is filled
+        either with a batch of ids or with a select of the temporary table.
+        """
+        batch_size = batch_size or self.batch_size
+        join_threshold = join_threshold or self.join_threshold
+        if len(norm_ids) > join_threshold:
+            # The temporary table is created on a connection of its own, since
+            # the connection of the thread may be shared with other threads or
+            # be reading for another query, and is dropped with the connection.
+            connection = self.open_connection()
+            try:
+                connection.execute("CREATE TEMP TABLE query_ids (id PRIMARY KEY)")
+                connection.executemany("INSERT OR IGNORE INTO temp.query_ids VALUES (?)", ((i,) for i in norm_ids))
+                yield from connection.execute(query % "SELECT id FROM temp.query_ids")
+            finally:
+                connection.close()
+            return
+        cursor = self.connection.cursor()
+        try:
+            for i in range(0, len(norm_ids), batch_size):
+                batch = norm_ids[i : i + batch_size]
+                cursor.execute(query % ",".join(["?"] * len(batch)), batch)
+                yield from cursor
+        finally:
+            cursor.close()
+
+    def fetch_doc_lines(self, norm_ids, batch_size=None, join_threshold=None):
+        rows = self.query_ids(
+            "SELECT id,lines FROM documents WHERE id IN (%s)", norm_ids, batch_size, join_threshold,
         )
-        results = cursor.fetchall()
-        cursor.close()
-        return results
+        for doc_id, lines in rows:
+            yield doc_id, self.decode_lines(lines)
+
+    def fetch_doc_sentences(self, norm_ids, batch_size=None, join_threshold=None):
+        if not self.has_sentences:
+            for doc_id, lines in self.fetch_doc_lines(norm_ids, batch_size, join_threshold):
+                yield doc_id, split_doc_lines(lines)
+            return
+        rows = self.query_ids(
+            "SELECT page_id,sent_id,text FROM sentences WHERE page_id IN (%s) ORDER BY page_id,rowid",
+            norm_ids, batch_size, join_threshold,
+        )
+        # The ids are distinct, so the sentences of a doc are all in one batch.
+        doc_id, sentences = None, None
+        for page_id, sent_id, text in rows:
+            if page_id != doc_id:
+                if sentences is not None:
+                    yield doc_id, sentences
+                doc_id, sentences = page_id, []
+            sentences.append((sent_id, text))
+        if sentences is not None:
+            yield doc_id, sentences
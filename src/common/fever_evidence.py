@@ -0,0 +1,81 @@
+"""Selection of the best scored evidence sentences of each claim."""
+
+import heapq
+import itertools
+import json
+from collections import defaultdict
+
+from tqdm import tqdm
+
+from common.fever_io import count_lines, iter_jsonl
+
+
+class Descending(object):
+    """Wrap a value to reverse its ordering."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class TopEvidence(object):
+    """Keep the 'k' sentences with the highest score pushed so far, breaking
+    ties in favour of the lowest evidence.
+
+    The kept sentences are in a min-heap whose root is the worst of them, so
+    that a sentence that does not make it is discarded in constant time.
+    """
+
+    def __init__(self, k=None):
+        self.k = k
+        self.heap = []
+
+    def push(self, score, page, sent_id, sent):
+        if self.k is not None and len(self.heap) >= self.k:
+            if self.k == 0 or score < self.heap[0][0]:
+                return
+            entry = (score, Descending((page, sent_id, sent)))
+            if self.heap[0] < entry:
+                heapq.heapreplace(self.heap, entry)
+        else:
+            heapq.heappush(self.heap, (score, Descending((page, sent_id, sent))))
+
+    def get(self):
+        """Return the kept (score, evidence) pairs, best first."""
+        return [(score, evid.value) for score, evid in sorted(self.heap, reverse=True)]
+
+
+def select_best_evidence(scored_rows, max_sentences_per_claim):
+    """Return the best 'max_sentences_per_claim' (score, evidence) pairs of
+    each claim in 'scored_rows', which are rows of sentences followed by their
+    score, by claim id."""
+    weighted_claim_evidence = defaultdict(lambda: [])
+    # The sentences of a claim are consecutive, so each group of rows is
+    # usually all the sentences of a claim.
+    top_evidence = {}
+    for claim_id, group in itertools.groupby(scored_rows, key=lambda row: row[0]):
+        claim_id = int(claim_id)
+        if claim_id not in top_evidence:
+            top_evidence[claim_id] = TopEvidence(max_sentences_per_claim)
+        top = top_evidence[claim_id]
+        for _, claim, page, sent_id, sent, score in group:
+            top.push(float(score), page, int(sent_id), sent)
+    for claim_id, top in top_evidence.items():
+        weighted_claim_evidence[claim_id] = top.get()
+    return weighted_claim_evidence
+
+
+def write_predicted_sentences(in_file, out_file, best_evidence):
+    """Write the claims of 'in_file' to 'out_file', each with its best
+    evidence as 'predicted_sentences'."""
+    with open(out_file, "w+") as fout:
+        nlines = count_lines(in_file)
+        lines = iter_jsonl(in_file)
+        for line in tqdm(lines, desc="Claim", total=nlines):
+            claim_id = line["id"]
+            line["predicted_sentences"] = best_evidence[claim_id]
+            fout.write(json.dumps(line) + "\n")
@@ -0,0 +1,436 @@
+"""Variable-length features of the FEVER examples, their storage and their
+batching."""
+
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from multiprocessing import Pool as ProcessPool
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+from tqdm import tqdm
+
+from common.fever_io import imap_bounded
+
+logger = logging.getLogger(__name__)
+
+
+# Version of the layout of the directories written by FeatureStore, and the
+# prefix of their names in a cache directory.
+FEATURE_STORE_VERSION = 1
+FEATURE_STORE_PREFIX = "cached_features_"
+
+
+class FeverFeatures(Dataset):
+    """Features of examples of different lengths, stored without padding, in
+    one or more shards.
+
+    In each shard, the token ids and token type ids of its examples are
+    concatenated, and 'offsets' holds the start of the tokens of each example,
+    followed by the total number of tokens. 'shards' is a list of (input ids,
+    token type ids, offsets) arrays, and 'labels' holds the labels of the
+    examples of all the shards. Items are (index, input ids, token type ids,
+    label) tuples.
+    """
+
+    def __init__(self, shards, labels):
+        self.shards = shards
+        self.labels = labels
+        shard_lengths = [np.diff(offsets) for _, _, offsets in shards]
+        self.lengths = np.concatenate(shard_lengths) if shard_lengths else np.zeros(0, dtype=np.int64)
+        self.shard_starts = np.cumsum([0] + [len(lengths) for lengths in shard_lengths])[:-1].tolist()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        shard = bisect.bisect_right(self.shard_starts, index) - 1
+        input_ids, token_type_ids, offsets = self.shards[shard]
+        start, end = offsets[index - self.shard_starts[shard]], offsets[index - self.shard_starts[shard] + 1]
+        return index, input_ids[start:end], token_type_ids[start:end], self.labels[index]
+
+
+class FeatureStore(object):
+    """Directory of the features of a dataset, in shards of memory-mappable
+    .npy files listed by a manifest.
+
+    The shards are added as the examples are tokenized, and the manifest is
+    rewritten after each of them, so that building a store that was
+    interrupted resumes after its last shard.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        manifest_file = os.path.join(self.path, "manifest.json")
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            if manifest["version"] == FEATURE_STORE_VERSION:
+                return manifest
+            logger.warning("Ignoring version %s of %s", manifest["version"], self.path)
+        return {"version": FEATURE_STORE_VERSION, "shards": [], "complete": False}
+
+    def save_manifest(self):
+        manifest_file = os.path.join(self.path, "manifest.json")
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    @property
+    def complete(self):
+        return self.manifest["complete"]
+
+    @property
+    def num_examples(self):
+        return sum(shard["num_examples"] for shard in self.manifest["shards"])
+
+    def shard_file(self, shard, name):
+        return os.path.join(self.path, "%05d.%s.npy" % (shard, name))
+
+    def add_shard(self, input_ids, token_type_ids, lengths, labels):
+        shard = len(self.manifest["shards"])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        arrays = {"input_ids": input_ids, "token_type_ids": token_type_ids, "offsets": offsets, "labels": labels}
+        for name, array in arrays.items():
+            with open(self.shard_file(shard, name) + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(self.shard_file(shard, name) + ".tmp", self.shard_file(shard, name))
+        self.manifest["shards"].append({"num_examples": len(lengths), "num_tokens": int(offsets[-1])})
+        self.save_manifest()
+
+    def build(self, examples, num_examples, tokenizer, max_length, label_list, output_mode,
+              num_workers=None, shard_size=100000, chunk_size=1000):
+        """Tokenize the 'num_examples' 'examples' into shards of 'shard_size'
+        examples, skipping the examples of the shards already stored.
+
+        See 'encode_examples' for the other arguments. Each shard is gathered
+        in arrays allocated for 'max_length' tokens per example.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        num_done = self.num_examples
+        if num_done > 0:
+            logger.info("Resuming %s after %d examples", self.path, num_done)
+        examples = itertools.islice(examples, num_done, None)
+
+        input_ids = np.empty(shard_size * max_length, dtype=np.int32)
+        token_type_ids = np.empty(shard_size * max_length, dtype=np.int8)
+        lengths = np.empty(shard_size, dtype=np.int64)
+        labels = np.empty(shard_size, dtype=np.int64 if output_mode == "classification" else np.float32)
+        count, num_tokens = 0, 0
+        chunks = encode_examples(examples, tokenizer, max_length, label_list, output_mode,
+                                 num_workers=num_workers, chunk_size=chunk_size)
+        with tqdm(desc="Example", initial=num_done, total=num_examples) as progress:
+            for chunk_input_ids, chunk_token_type_ids, chunk_lengths, chunk_labels in chunks:
+                chunk_offsets = np.concatenate([[0], np.cumsum(chunk_lengths)])
+                position = 0
+                # copy the chunk into the current shard, splitting it when the
+                # shard is full
+                while position < len(chunk_lengths):
+                    n = min(shard_size - count, len(chunk_lengths) - position)
+                    start, end = chunk_offsets[position], chunk_offsets[position + n]
+                    input_ids[num_tokens : num_tokens + end - start] = chunk_input_ids[start:end]
+                    token_type_ids[num_tokens : num_tokens + end - start] = chunk_token_type_ids[start:end]
+                    lengths[count : count + n] = chunk_lengths[position : position + n]
+                    labels[count : count + n] = chunk_labels[position : position + n]
+                    count, num_tokens, position = count + n, num_tokens + end - start, position + n
+                    if count == shard_size:
+                        self.add_shard(input_ids[:num_tokens], token_type_ids[:num_tokens], lengths[:count], labels[:count])
+                        count, num_tokens = 0, 0
+                progress.update(len(chunk_lengths))
+        if count > 0:
+            self.add_shard(input_ids[:num_tokens], token_type_ids[:num_tokens], lengths[:count], labels[:count])
+        self.manifest["complete"] = True
+        self.save_manifest()
+
+    def open(self):
+        """Return the features of the store, as memory-mapped arrays.
+
+        The manifest is touched, to record the last use of the store.
+        """
+        os.utime(os.path.join(self.path, "manifest.json"))
+        shards = []
+        labels = []
+        for shard in range(len(self.manifest["shards"])):
+            shards.append(tuple(np.load(self.shard_file(shard, name), mmap_mode="r")
+                                for name in ("input_ids", "token_type_ids", "offsets")))
+            labels.append(np.load(self.shard_file(shard, "labels"), mmap_mode="r"))
+        return FeverFeatures(shards, np.concatenate(labels) if labels else np.zeros(0))
+
+
+def iter_streamed_batches(examples, tokenizer, max_length, label_list, output_mode, batch_size, collator,
+                          num_workers=None, max_pending=16):
+    """Lazily tokenize the 'examples' in a background thread and yield their
+    batches, padded by 'collator', in the order of the examples.
+
+    At most 'max_pending' batches are kept ahead of the ones consumed. See
+    'encode_examples' for the other arguments.
+    """
+    batches = queue.Queue(max_pending)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        chunks = encode_examples(examples, tokenizer, max_length, label_list, output_mode,
+                                 num_workers=num_workers, chunk_size=batch_size)
+        try:
+            index = 0
+            for input_ids, token_type_ids, lengths, labels in chunks:
+                offsets = np.concatenate([[0], np.cumsum(lengths)])
+                items = [(index + i, input_ids[offsets[i] : offsets[i + 1]], token_type_ids[offsets[i] : offsets[i + 1]],
+                          labels[i]) for i in range(len(lengths))]
+                index += len(lengths)
+                if not put(collator(items)):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            chunks.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is done:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        # Unblock the producer if the batches were not all consumed.
+        stopped.set()
+        producer.join()
+
+
+def hash_path(path, digest, buffer_size=1 << 20):
+    """Update 'digest' with the contents of the file 'path', or of all the
+    files of the directory 'path' and their names."""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+    for file in files:
+        digest.update(("%s:%d\n" % (os.path.relpath(file, path), os.path.getsize(file))).encode("utf-8"))
+        with open(file, "rb") as f:
+            for buffer in iter(lambda: f.read(buffer_size), b""):
+                digest.update(buffer)
+
+
+def feature_store_path(cache_dir, file_path, tokenizer, *params):
+    """Return the path of the store, in 'cache_dir', of the features of the
+    examples of 'file_path' tokenized by 'tokenizer' with 'params'.
+
+    The name of the store is a hash of the contents of 'file_path', of the
+    files saved by the tokenizer and of the JSON serializable 'params', so
+    that stores are shared by identical inputs and never reused for changed
+    ones.
+    """
+    digest = hashlib.sha256()
+    hash_path(file_path, digest)
+    with tempfile.TemporaryDirectory() as tokenizer_dir:
+        tokenizer.save_pretrained(tokenizer_dir)
+        hash_path(tokenizer_dir, digest)
+    digest.update(json.dumps([FEATURE_STORE_VERSION] + list(params)).encode("utf-8"))
+    return os.path.join(cache_dir, FEATURE_STORE_PREFIX + digest.hexdigest())
+
+
+def evict_feature_stores(cache_dir, max_size, keep=()):
+    """Remove the least recently used stores of 'cache_dir', except the ones
+    in 'keep', until all its stores take at most 'max_size' bytes."""
+    stores = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not name.startswith(FEATURE_STORE_PREFIX) or not os.path.isdir(path):
+            continue
+        files = [os.path.join(path, file) for file in os.listdir(path)]
+        manifest_file = os.path.join(path, "manifest.json")
+        last_used = os.path.getmtime(manifest_file if os.path.exists(manifest_file) else path)
+        stores.append((last_used, sum(os.path.getsize(file) for file in files), path))
+    total_size = sum(size for _, size, _ in stores)
+    for _, size, path in sorted(stores):
+        if total_size <= max_size:
+            break
+        if path in keep:
+            continue
+        logger.info("Evicting %s (%d bytes)", path, size)
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+
+def encode_examples(examples, tokenizer, max_length, label_list, output_mode, num_workers=None, chunk_size=1000):
+    """Lazily tokenize the 'examples' in chunks of 'chunk_size', with
+    'num_workers' processes when set, and yield the (input ids, token type
+    ids, lengths, labels) arrays of each chunk (see 'encode_pairs')."""
+    if output_mode == "classification":
+        label_map = {label: i for i, label in enumerate(label_list)}
+        label_dtype = np.int64
+    elif output_mode == "regression":
+        label_dtype = np.float32
+    else:
+        raise KeyError(output_mode)
+
+    def iter_chunks():
+        pairs, labels = [], []
+        for example in examples:
+            pairs.append((example.text_a, example.text_b))
+            labels.append(label_map[example.label] if output_mode == "classification" else float(example.label))
+            if len(pairs) >= chunk_size:
+                yield pairs, np.array(labels, dtype=label_dtype)
+                pairs, labels = [], []
+        if pairs:
+            yield pairs, np.array(labels, dtype=label_dtype)
+
+    if num_workers is None:
+        encoded_chunks = (encode_pairs(tokenizer, pairs, max_length) + (labels,) for pairs, labels in iter_chunks())
+    else:
+        pool = ProcessPool(num_workers, initializer=init_worker, initargs=(tokenizer, max_length))
+        encoded_chunks = imap_bounded(pool, encode_worker_chunk, iter_chunks(), 4 * num_workers)
+
+    try:
+        for i, chunk in enumerate(encoded_chunks):
+            if i == 0:
+                input_ids, token_type_ids, lengths, labels = chunk
+                for start, end, label in list(zip(np.cumsum(lengths) - lengths, np.cumsum(lengths), labels))[:5]:
+                    logger.info("*** Example ***")
+                    logger.info("input_ids: %s" % " ".join(str(x) for x in input_ids[start:end]))
+                    logger.info("token_type_ids: %s" % " ".join(str(x) for x in token_type_ids[start:end]))
+                    logger.info("label: %s" % label)
+            yield chunk
+    finally:
+        if num_workers is not None:
+            pool.terminate()
+
+
+def encode_pairs(tokenizer, pairs, max_length):
+    """Tokenize the (text a, text b) 'pairs', truncated to 'max_length'
+    tokens, and return their concatenated token ids and token type ids, and
+    their lengths.
+
+    Fast tokenizers encode the whole batch at once, other tokenizers encode
+    the pairs one by one.
+    """
+    if getattr(tokenizer, "is_fast", False):
+        encoded = tokenizer.batch_encode_plus(pairs, add_special_tokens=True, max_length=max_length,
+                                              truncation="longest_first", return_token_type_ids=True,
+                                              return_attention_mask=False)
+        all_input_ids, all_token_type_ids = encoded["input_ids"], encoded["token_type_ids"]
+    else:
+        all_input_ids, all_token_type_ids = [], []
+        for text_a, text_b in pairs:
+            inputs = tokenizer.encode_plus(text_a, text_b, add_special_tokens=True, max_length=max_length)
+            all_input_ids.append(inputs["input_ids"])
+            all_token_type_ids.append(inputs["token_type_ids"])
+
+    lengths = np.fromiter((len(ids) for ids in all_input_ids), dtype=np.int64, count=len(all_input_ids))
+    assert (lengths <= max_length).all(), "Error with input length {} vs {}".format(lengths.max(), max_length)
+    input_ids = np.empty(lengths.sum(), dtype=np.int32)
+    token_type_ids = np.empty(lengths.sum(), dtype=np.int8)
+    start = 0
+    for ids, types in zip(all_input_ids, all_token_type_ids):
+        input_ids[start : start + len(ids)] = ids
+        token_type_ids[start : start + len(ids)] = types
+        start += len(ids)
+    return input_ids, token_type_ids, lengths
+
+
+WORKER_TOKENIZER = None
+WORKER_MAX_LENGTH = None
+
+
+def init_worker(tokenizer, max_length):
+    global WORKER_TOKENIZER, WORKER_MAX_LENGTH
+    WORKER_TOKENIZER = tokenizer
+    WORKER_MAX_LENGTH = max_length
+
+
+def encode_worker_chunk(chunk):
+    pairs, labels = chunk
+    return encode_pairs(WORKER_TOKENIZER, pairs, WORKER_MAX_LENGTH) + (labels,)
+
+
+class FeatureCollator(object):
+    """Pad the features of a batch to the length of its longest example.
+
+    Batches are (input ids, attention mask, token type ids, labels, indices)
+    tuples of tensors.
+    """
+
+    def __init__(self, pad_token=0, pad_token_segment_id=0, pad_on_left=False):
+        self.pad_token = pad_token
+        self.pad_token_segment_id = pad_token_segment_id
+        self.pad_on_left = pad_on_left
+
+    def __call__(self, items):
+        max_length = max(len(input_ids) for _, input_ids, _, _ in items)
+        input_ids = torch.full((len(items), max_length), self.pad_token, dtype=torch.long)
+        attention_mask = torch.zeros((len(items), max_length), dtype=torch.long)
+        token_type_ids = torch.full((len(items), max_length), self.pad_token_segment_id, dtype=torch.long)
+        for i, (_, example_input_ids, example_token_type_ids, _) in enumerate(items):
+            length = len(example_input_ids)
+            positions = slice(max_length - length, max_length) if self.pad_on_left else slice(0, length)
+            input_ids[i, positions] = torch.from_numpy(np.asarray(example_input_ids, dtype=np.int64))
+            attention_mask[i, positions] = 1
+            token_type_ids[i, positions] = torch.from_numpy(np.asarray(example_token_type_ids, dtype=np.int64))
+        labels = torch.from_numpy(np.array([label for _, _, _, label in items]))
+        indices = torch.tensor([index for index, _, _, _ in items], dtype=torch.long)
+        return input_ids, attention_mask, token_type_ids, labels, indices
+
+
+class LengthBucketSampler(Sampler):
+    """Batch sampler that groups examples of similar lengths, to reduce the
+    padding of the batches.
+
+    When shuffling, the examples are shuffled and split in buckets of
+    'bucket_size' batches, each bucket is sorted by length and cut in
+    batches, and the batches are shuffled. Otherwise the examples are sorted
+    from the longest to the shortest, and the original order has to be
+    restored from the indices of the batches.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=False, bucket_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.lengths))
+            batches = []
+            step = self.bucket_size * self.batch_size
+            for start in range(0, len(order), step):
+                bucket = order[start : start + step]
+                bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+                batches.extend(bucket[i : i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        else:
+            order = np.argsort(-self.lengths, kind="stable")
+            batches = [order[i : i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        for batch in batches:
+            yield batch.tolist()
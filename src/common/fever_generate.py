@@ -0,0 +1,61 @@
+"""Generation of the rows of sentences of the claims, by the generate scripts
+of the pipeline stages."""
+
+import os
+from multiprocessing import Pool as ProcessPool
+
+from tqdm import tqdm
+
+from common.fever_doc_db import FeverDocDB
+from common.fever_io import imap_bounded, iter_chunks
+
+
+WORKER_DB = None
+
+
+def init_worker(db_file, db_cache_size):
+    global WORKER_DB
+    WORKER_DB = FeverDocDB(db_file, cache_size=db_cache_size, read_only=True)
+
+
+def process_shard(args):
+    write_claims, lines, kwargs = args
+    rows = []
+    write_claims(rows, WORKER_DB, lines, **kwargs)
+    return len(lines), rows, os.getpid(), WORKER_DB.cache_info()
+
+
+def print_cache_info(cache_info, num_workers=None):
+    workers = "" if num_workers is None else " (summed over %d workers)" % num_workers
+    print(("db cache%s: {hits} hits, {misses} misses, {evictions} evictions, {entries} entries, {size}/{max_size} bytes" % workers).format(**cache_info))
+
+
+def write_rows(writer, write_claims, db_file, lines, nlines, db_cache_size=0, num_workers=None, shard_size=128,
+               **kwargs):
+    """Append to 'writer' the rows generated by 'write_claims(rows, db, lines,
+    **kwargs)' for the 'nlines' claims of 'lines', in the order of the claims.
+
+    When 'num_workers' is set, the claims are split in shards of 'shard_size'
+    claims, each processed by a worker process with its own read-only
+    connection to the database and its own cache, whose counters are summed.
+    """
+    if num_workers is None:
+        db = FeverDocDB(db_file, cache_size=db_cache_size)
+        write_claims(writer, db, tqdm(lines, total=nlines), **kwargs)
+        if db.cache is not None:
+            print_cache_info(db.cache_info())
+        return
+    # latest counters of the cache of each worker, by process id
+    cache_infos = {}
+    shards = ((write_claims, shard, kwargs) for shard in iter_chunks(lines, shard_size))
+    with ProcessPool(num_workers, initializer=init_worker, initargs=(db_file, db_cache_size)) as pool, \
+            tqdm(total=nlines) as progress:
+        for count, rows, pid, cache_info in imap_bounded(pool, process_shard, shards, 4 * num_workers):
+            for row in rows:
+                writer.append(row)
+            progress.update(count)
+            if cache_info is not None:
+                cache_infos[pid] = cache_info
+    if cache_infos:
+        print_cache_info({key: sum(info[key] for info in cache_infos.values()) for key in next(iter(cache_infos.values()))},
+                         len(cache_infos))
@@ -0,0 +1,297 @@
+"""Streaming readers and writers of the files exchanged by the stages of the
+pipeline."""
+
+import csv
+import itertools
+import json
+import mmap
+import os
+import shutil
+import threading
+from array import array
+
+import numpy as np
+
+
+def count_lines(path, buffer_size=1 << 20):
+    """Count the lines of 'path' by scanning its bytes, without decoding them."""
+    count = 0
+    last = b"\n"
+    with open(path, "rb") as f:
+        while True:
+            buffer = f.read(buffer_size)
+            if not buffer:
+                break
+            count += buffer.count(b"\n")
+            last = buffer[-1:]
+    # The last line may not end with a newline.
+    return count if last == b"\n" else count + 1
+
+
+def iter_jsonl(path):
+    """Lazily parse each line of 'path' as a JSON document."""
+    with open(path, "r") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def iter_tsv(path):
+    """Lazily split each line of 'path' in its tab separated fields."""
+    with open(path, "r") as f:
+        yield from csv.reader(f, delimiter="\t")
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """Like 'pool.imap', but reads at most 'max_pending' items of 'iterable'
+    ahead of the results consumed, instead of queueing all of them."""
+    semaphore = threading.Semaphore(max_pending)
+    stopped = threading.Event()
+
+    def feed():
+        for item in iterable:
+            semaphore.acquire()
+            if stopped.is_set():
+                return
+            yield item
+
+    try:
+        for result in pool.imap(func, feed()):
+            semaphore.release()
+            yield result
+    finally:
+        # Unblock the feeder, so that the pool can be closed.
+        stopped.set()
+        semaphore.release()
+
+
+def iter_chunks(iterable, chunk_size):
+    """Lazily split the items of 'iterable' in lists of 'chunk_size' items,
+    the last one possibly shorter."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Rows of sentences exchanged between the generate scripts, the models and the
+# run scripts, i.e. (claim id, claim, page, sentence id, sentence[, label]).
+ROW_FORMATS = ["tsv", "columnar"]
+COLUMNAR_VERSION = 1
+
+
+class TsvRowWriter(object):
+    """Write rows of sentences to a tab separated file."""
+
+    def __init__(self, path):
+        self.file = open(path, "w+")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, row):
+        self.file.write("\t".join(row) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarRowWriter(object):
+    """Write rows of sentences to a directory of columns.
+
+    The text of each claim and page is stored once, in a string table, and the
+    rows refer to them by index. Each string table is a blob of utf-8 text
+    with an array of offsets, and all arrays are stored as .npy files, so that
+    readers can memory-map them. The directory is written aside and moved in
+    place once closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(self.path + ".tmp"):
+            shutil.rmtree(self.path + ".tmp")
+        os.makedirs(self.path + ".tmp")
+        self.sentences = open(os.path.join(self.path + ".tmp", "sentences.bin"), "wb")
+        self.sentence_offsets = array("q", [0])
+        self.claim_ids = array("q")
+        self.claims = {}
+        self.pages = {}
+        self.labels = {}
+        self.row_claims = array("i")
+        self.row_pages = array("i")
+        self.row_sent_ids = array("i")
+        self.row_labels = array("b")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, row):
+        claim_id, claim, page, sent_id, sentence = row[:5]
+        claim_id = int(claim_id)
+        if claim_id not in self.claims:
+            self.claims[claim_id] = (len(self.claims), claim)
+            self.claim_ids.append(claim_id)
+        self.row_claims.append(self.claims[claim_id][0])
+        self.row_pages.append(self.pages.setdefault(page, len(self.pages)))
+        self.row_sent_ids.append(int(sent_id))
+        data = sentence.encode("utf-8")
+        self.sentences.write(data)
+        self.sentence_offsets.append(self.sentence_offsets[-1] + len(data))
+        if len(row) > 5:
+            self.row_labels.append(self.labels.setdefault(row[5], len(self.labels)))
+
+    def close(self):
+        tmp_path = self.path + ".tmp"
+        self.sentences.close()
+        self.save_strings(tmp_path, "claims", [claim for _, claim in self.claims.values()])
+        self.save_strings(tmp_path, "pages", list(self.pages))
+        np.save(os.path.join(tmp_path, "sentences.offsets.npy"), np.frombuffer(self.sentence_offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "claim_ids.npy"), np.frombuffer(self.claim_ids, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "row_claims.npy"), np.frombuffer(self.row_claims, dtype=np.int32))
+        np.save(os.path.join(tmp_path, "row_pages.npy"), np.frombuffer(self.row_pages, dtype=np.int32))
+        np.save(os.path.join(tmp_path, "row_sent_ids.npy"), np.frombuffer(self.row_sent_ids, dtype=np.int32))
+        labels = None
+        if len(self.labels) > 0:
+            if len(self.row_labels) != len(self.row_claims):
+                raise ValueError("Either all or none of the rows must have a label")
+            np.save(os.path.join(tmp_path, "row_labels.npy"), np.frombuffer(self.row_labels, dtype=np.int8))
+            labels = list(self.labels)
+        manifest = {
+            "version": COLUMNAR_VERSION,
+            "num_rows": len(self.row_claims),
+            "num_claims": len(self.claims),
+            "num_pages": len(self.pages),
+            "labels": labels,
+        }
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path) if os.path.isdir(self.path) else os.remove(self.path)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def save_strings(path, name, strings):
+        offsets = array("q", [0])
+        with open(os.path.join(path, name + ".bin"), "wb") as f:
+            for string in strings:
+                data = string.encode("utf-8")
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+        np.save(os.path.join(path, name + ".offsets.npy"), np.frombuffer(offsets, dtype=np.int64))
+
+
+class ColumnarRows(object):
+    """Memory-mapped reader of the rows written by ColumnarRowWriter.
+
+    The rows are iterated as lists like the ones of a tab separated file,
+    except that the claim and sentence ids are integers.
+    """
+
+    def __init__(self, path, block_size=65536):
+        self.path = path
+        self.block_size = block_size
+        with open(os.path.join(self.path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest["version"] != COLUMNAR_VERSION:
+            raise ValueError("Unsupported version %s of %s" % (self.manifest["version"], self.path))
+        self.labels = self.manifest["labels"]
+
+    def __len__(self):
+        return self.manifest["num_rows"]
+
+    def load(self, name):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    def load_blob(self, name):
+        with open(os.path.join(self.path, name + ".bin"), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load_strings(self, name):
+        blob = self.load_blob(name)
+        offsets = self.load(name + ".offsets").tolist()
+        return [blob[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+    def __iter__(self):
+        claim_ids = self.load("claim_ids").tolist()
+        claims = self.load_strings("claims")
+        pages = self.load_strings("pages")
+        sentences = self.load_blob("sentences")
+        sentence_offsets = self.load("sentences.offsets")
+        row_claims = self.load("row_claims")
+        row_pages = self.load("row_pages")
+        row_sent_ids = self.load("row_sent_ids")
+        row_labels = self.load("row_labels") if self.labels is not None else None
+        for start in range(0, len(self), self.block_size):
+            end = min(start + self.block_size, len(self))
+            offsets = sentence_offsets[start : end + 1].tolist()
+            block_claims = row_claims[start:end].tolist()
+            block_pages = row_pages[start:end].tolist()
+            block_sent_ids = row_sent_ids[start:end].tolist()
+            block_labels = row_labels[start:end].tolist() if row_labels is not None else None
+            for i in range(end - start):
+                claim = block_claims[i]
+                row = [
+                    claim_ids[claim],
+                    claims[claim],
+                    pages[block_pages[i]],
+                    block_sent_ids[i],
+                    sentences[offsets[i] : offsets[i + 1]].decode("utf-8"),
+                ]
+                if block_labels is not None:
+                    row.append(self.labels[block_labels[i]])
+                yield row
+
+
+def is_columnar(path):
+    """Check whether 'path' holds rows written by ColumnarRowWriter."""
+    return os.path.isfile(os.path.join(path, "manifest.json"))
+
+
+def open_row_writer(path, row_format="tsv"):
+    """Open a writer of rows of sentences in 'row_format' (see ROW_FORMATS)."""
+    if row_format == "columnar":
+        return ColumnarRowWriter(path)
+    return TsvRowWriter(path)
+
+
+def count_rows(path):
+    """Count the rows of sentences stored in 'path', in any of ROW_FORMATS."""
+    return len(ColumnarRows(path)) if is_columnar(path) else count_lines(path)
+
+
+def iter_rows(path):
+    """Lazily read the rows of sentences stored in 'path', in any of ROW_FORMATS."""
+    return iter(ColumnarRows(path)) if is_columnar(path) else iter_tsv(path)
+
+
+def iter_predicted_rows(rows_path, predictions_path):
+    """Lazily read the rows of sentences stored in 'rows_path', each extended
+    with its prediction, from the matching line of 'predictions_path'.
+
+    Raise a ValueError if there are not as many rows as predictions.
+    """
+    message = "%s and %s have different numbers of rows" % (rows_path, predictions_path)
+    with open(predictions_path, "r") as predictions:
+        for row, prediction in zip_equal(iter_rows(rows_path), predictions, message=message):
+            yield list(row) + [prediction.rstrip("\n")]
+
+
+def zip_equal(*iterables, message="The iterables have different lengths"):
+    """Like 'zip', but raise a ValueError with 'message' when any of the
+    'iterables' has items left once another one is exhausted."""
+    missing = object()
+    for items in itertools.zip_longest(*iterables, fillvalue=missing):
+        if any(item is missing for item in items):
+            raise ValueError(message)
+        yield items
@@ -13,12 +13,12 @@ import glob
 import logging
 import os
 import random
+import shutil
 import json
 
 import numpy as np
 import torch
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 
 try:
@@ -49,11 +49,15 @@ from transformers import (WEIGHTS_NAME, BertConfig,
                                 )
 
 from transformers import AdamW, get_linear_schedule_with_warmup
+import transformers
 
+from common.fever_evidence import select_best_evidence, write_predicted_sentences
+from common.fever_features import (FeatureCollator, FeatureStore, LengthBucketSampler, evict_feature_stores,
+                                   feature_store_path, iter_streamed_batches)
+from common.fever_io import iter_rows, zip_equal
 from common.fever_processors import fever_compute_metrics as compute_metrics
 from common.fever_processors import fever_output_modes as output_modes
 from common.fever_processors import fever_processors as processors
-from common.fever_processors import fever_convert_examples_to_features as convert_examples_to_features
 
 logger = logging.getLogger(__name__)
 
@@ -71,6 +75,10 @@ MODEL_CLASSES = {
 }
 
 
+# Version of the features stored in the cache, to bump whenever they change.
+FEATURES_VERSION = 3
+
+
 def set_seed(args):
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -90,8 +98,13 @@ def train(args, model, tokenizer):
         tb_writer = SummaryWriter()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    if args.local_rank == -1:
+        train_sampler = LengthBucketSampler(train_dataset.lengths, args.train_batch_size, shuffle=True)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=get_collator(args, tokenizer))
+    else:
+        train_sampler = DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size,
+                                      collate_fn=get_collator(args, tokenizer))
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -229,8 +242,8 @@ def evaluate(args, model, tokenizer, prefix=""):
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    eval_sampler = LengthBucketSampler(eval_dataset.lengths, args.eval_batch_size)
+    eval_dataloader = DataLoader(eval_dataset, batch_sampler=eval_sampler, collate_fn=get_collator(args, tokenizer))
 
     # multi-gpu eval
     if args.n_gpu > 1:
@@ -288,100 +301,133 @@ def predict(args, model, tokenizer):
     predict_in_file = args.predict_in_file
     predict_out_file = args.predict_out_file
     predict_output_dir = os.path.dirname(predict_out_file)
-    predict_dataset = load_and_cache_examples(args, predict_task, tokenizer, predict_in_file, purpose="predict")
 
     if not os.path.exists(predict_output_dir) and args.local_rank in [-1, 0]:
         os.makedirs(predict_output_dir)
 
     args.predict_batch_size = args.per_gpu_predict_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    predict_sampler = SequentialSampler(predict_dataset)
-    predict_dataloader = DataLoader(predict_dataset, sampler=predict_sampler, batch_size=args.predict_batch_size)
 
     # multi-gpu prediction
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
+    if args.stream_predictions:
+        # Tokenize the examples in the background while the model scores the
+        # previous batches, without caching their features. The batches are
+        # in the order of the examples.
+        processor = processors[predict_task]()
+        num_examples = processor.get_length(predict_in_file)
+        predict_batches = iter_streamed_batches(processor.get_examples(predict_in_file, "predict"),
+                                                tokenizer,
+                                                max_length=args.max_seq_length,
+                                                label_list=processor.get_labels(),
+                                                output_mode=args.output_mode,
+                                                batch_size=args.predict_batch_size,
+                                                collator=get_collator(args, tokenizer),
+                                                num_workers=args.preprocessing_num_workers,
+        )
+        predictions = (pred for _, preds in iter_predictions(args, model, predict_batches) for pred in preds)
+    else:
+        predict_dataset = load_and_cache_examples(args, predict_task, tokenizer, predict_in_file, purpose="predict")
+        num_examples = len(predict_dataset)
+        # Note that DistributedSampler samples randomly
+        predict_sampler = LengthBucketSampler(predict_dataset.lengths, args.predict_batch_size)
+        predict_dataloader = DataLoader(predict_dataset, batch_sampler=predict_sampler, collate_fn=get_collator(args, tokenizer))
+
     # Predict!
     logger.info("***** Running prediction *****")
-    logger.info("  Num examples = %d", len(predict_dataset))
+    logger.info("  Num examples = %d", num_examples)
     logger.info("  Batch size = %d", args.predict_batch_size)
-    with open(predict_out_file, "w") as writer:
-        for batch in tqdm(predict_dataloader, desc="Predicting"):
-            model.eval()
-            with torch.no_grad():
-                inputs = {"input_ids":      batch[0].long().to(args.device),
-                          "attention_mask": batch[1].to(args.device),
-                          "labels":         batch[3].to(args.device)}
-                if args.model_type != "distilbert":
-                    inputs["token_type_ids"] = batch[2].long().to(args.device) if args.model_type in ["bert", "xlnet", "albert"] else None  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
-                outputs = model(**inputs)
-                logits = outputs[1]
-
-            preds = logits.detach().cpu().numpy()
-            if args.output_mode == "classification":
-                preds = np.argmax(preds, axis=1)
-            elif args.output_mode == "regression":
-                preds = np.squeeze(preds, axis=1)
-            for pred in preds:
+    if not args.stream_predictions:
+        # The batches are sorted by length, so restore the order of the examples.
+        ordered_predictions = np.empty(len(predict_dataset), dtype=np.int64 if args.output_mode == "classification" else np.float32)
+        for indices, preds in iter_predictions(args, model, predict_dataloader):
+            ordered_predictions[indices] = preds
+        predictions = iter(ordered_predictions)
+    if args.predict_claims_file:
+        # Score and select at once the best sentences of each claim, instead
+        # of writing the scores to be joined with the predicted sentences.
+        if args.output_mode != "regression":
+            raise ValueError("Only the sentences scored by a regression model can be selected.")
+        # Go through the string representation of the scores, like the
+        # selection from a file of scores.
+        message = "%s and its predictions have different numbers of rows" % predict_in_file
+        scored_rows = (list(row) + [str(pred)] for row, pred in zip_equal(iter_rows(predict_in_file), predictions, message=message))
+        best_evidence = select_best_evidence(scored_rows, args.max_sentences_per_claim)
+        write_predicted_sentences(args.predict_claims_file, predict_out_file, best_evidence)
+    else:
+        with open(predict_out_file, "w") as writer:
+            for pred in predictions:
                 writer.write(str(pred) + "\n")
 
 
+def iter_predictions(args, model, predict_dataloader):
+    for batch in tqdm(predict_dataloader, desc="Predicting"):
+        model.eval()
+        with torch.no_grad():
+            inputs = {"input_ids":      batch[0].long().to(args.device),
+                      "attention_mask": batch[1].to(args.device),
+                      "labels":         batch[3].to(args.device)}
+            if args.model_type != "distilbert":
+                inputs["token_type_ids"] = batch[2].long().to(args.device) if args.model_type in ["bert", "xlnet", "albert"] else None  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
+            outputs = model(**inputs)
+            logits = outputs[1]
+
+        preds = logits.detach().cpu().numpy()
+        if args.output_mode == "classification":
+            preds = np.argmax(preds, axis=1)
+        elif args.output_mode == "regression":
+            preds = np.squeeze(preds, axis=1)
+        yield batch[4].numpy(), preds
+
+
 def load_and_cache_examples(args, task, tokenizer, file_path, purpose="train"):
-    if args.local_rank not in [-1, 0] and purpose == "train":
+    if args.local_rank not in [-1, 0] and purpose == "training":
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
     processor = processors[task]()
     output_mode = output_modes[task]
     # Load data features from cache or dataset file
-    cached_features_file = os.path.join(os.path.dirname(file_path), "cached_{}_{}_{}_{}.pt".format(
-        os.path.basename(file_path),
-        list(filter(None, args.model_name_or_path.split("/"))).pop(),
-        str(args.max_seq_length),
-        str(task)))
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        all_features_list = torch.load(cached_features_file)
+    cache_dir = args.features_cache_dir if args.features_cache_dir else os.path.dirname(file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_features_dir = feature_store_path(cache_dir, file_path, tokenizer,
+                                             FEATURES_VERSION, args.max_seq_length, task, purpose)
+    if args.overwrite_cache and args.local_rank in [-1, 0] and os.path.exists(cached_features_dir):
+        shutil.rmtree(cached_features_dir)
+    store = FeatureStore(cached_features_dir)
+    if store.complete:
+        logger.info("Loading features from cached directory %s", cached_features_dir)
     else:
-        logger.info("Creating features from dataset file at %s", file_path)
+        logger.info("Creating features from dataset file at %s into %s", file_path, cached_features_dir)
         examples = processor.get_examples(file_path, purpose)
         num_examples = processor.get_length(file_path)
-        features = convert_examples_to_features(examples,
-                                                tokenizer,
-                                                task=task,
-                                                max_length=args.max_seq_length,
-                                                output_mode=output_mode,
-                                                pad_on_left=bool(args.model_type in ["xlnet"]),                 # pad on the left for xlnet
-                                                pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-                                                pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+        # Tokenize the examples without padding, they are padded to the
+        # longest example of each batch
+        store.build(examples,
+                    num_examples,
+                    tokenizer,
+                    max_length=args.max_seq_length,
+                    label_list=processor.get_labels(),
+                    output_mode=output_mode,
+                    num_workers=args.preprocessing_num_workers,
+                    shard_size=args.features_shard_size,
         )
+    dataset = store.open()
+    if args.features_cache_size > 0 and args.local_rank in [-1, 0]:
+        evict_feature_stores(cache_dir, args.features_cache_size, keep=[cached_features_dir])
 
-        # Convert to Tensors and build dataset
-        all_input_ids = torch.empty((num_examples, args.max_seq_length), dtype=torch.int)
-        all_attention_mask = torch.empty((num_examples, args.max_seq_length), dtype=torch.int8)
-        all_token_type_ids = torch.empty((num_examples, args.max_seq_length), dtype=torch.int8)
-        if output_mode == "classification":
-            all_labels = torch.empty(num_examples, dtype=torch.long)
-        elif output_mode == "regression":
-            all_labels = torch.empty(num_examples, dtype=torch.float)
-        for i, feature in enumerate(tqdm(features, desc="Example", total=num_examples)):
-            all_input_ids[i] = torch.tensor(feature.input_ids)
-            all_attention_mask[i] = torch.tensor(feature.attention_mask)
-            all_token_type_ids[i] = torch.tensor(feature.token_type_ids)
-            all_labels[i] = feature.label
-        all_features_list = [all_input_ids, all_attention_mask, all_token_type_ids, all_labels]
-
-        if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(all_features_list, cached_features_file)
-
-    if args.local_rank == 0 and purpose == "train":
+    if args.local_rank == 0 and purpose == "training":
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    dataset = TensorDataset(*all_features_list)
     return dataset
 
 
+def get_collator(args, tokenizer):
+    return FeatureCollator(pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                           pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+                           pad_on_left=bool(args.model_type in ["xlnet"]))
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -402,12 +448,29 @@ def main():
                         help="Input file for prediciton.")
     parser.add_argument("--predict_out_file", default=None, type=str,
                         help="Output file for prediciton.")
+    parser.add_argument("--predict_claims_file", default=None, type=str,
+                        help="Claims to write to the output file for prediction, each with its top scored sentences, "
+                             "instead of the scores of the sentences.")
+    parser.add_argument("--stream_predictions", action="store_true",
+                        help="Tokenize the examples to predict while predicting, instead of caching their features first")
+    parser.add_argument("--max_sentences_per_claim", default=5, type=int,
+                        help="Number of top scored sentences to keep for each claim.")
 
     ## Other parameters
     parser.add_argument("--config_name", default="", type=str,
                         help="Pretrained config name or path if not the same as model_name")
     parser.add_argument("--tokenizer_name", default="", type=str,
                         help="Pretrained tokenizer name or path if not the same as model_name")
+    parser.add_argument("--use_fast_tokenizer", action="store_true",
+                        help="Use the fast tokenizer of the model type, when this version of transformers has one")
+    parser.add_argument("--preprocessing_num_workers", default=None, type=int,
+                        help="Number of processes tokenizing the examples (by default they are tokenized in the main process)")
+    parser.add_argument("--features_shard_size", default=100000, type=int,
+                        help="Number of examples per shard of the cached features, which are saved as each shard is complete")
+    parser.add_argument("--features_cache_dir", default="", type=str,
+                        help="Where to cache the features of the input files (by default next to each input file)")
+    parser.add_argument("--features_cache_size", default=0, type=int,
+                        help="Maximum size in bytes of the cached features, beyond which the least recently used are removed (0 for no limit)")
     parser.add_argument("--cache_dir", default="", type=str,
                         help="Where do you want to store the pre-trained models downloaded from s3")
     parser.add_argument("--max_seq_length", default=128, type=int,
@@ -521,6 +584,12 @@ def main():
 
     args.model_type = args.model_type.lower()
     config_class, model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+    if args.use_fast_tokenizer:
+        fast_tokenizer_class = getattr(transformers, tokenizer_class.__name__ + "Fast", None)
+        if fast_tokenizer_class is not None:
+            tokenizer_class = fast_tokenizer_class
+        else:
+            logger.warning("No fast tokenizer for %s, using %s", args.model_type, tokenizer_class.__name__)
     config = config_class.from_pretrained(args.config_name if args.config_name else args.model_name_or_path,
                                           num_labels=num_labels,
                                           finetuning_task=args.task_name,
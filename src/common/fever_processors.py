@@ -14,6 +14,8 @@ import numpy as np
 from transformers.data.processors.utils import DataProcessor, InputExample, InputFeatures
 from transformers.file_utils import is_tf_available
 
+from common.fever_io import ColumnarRows, is_columnar
+
 
 if is_tf_available():
     import tensorflow as tf
@@ -193,19 +195,27 @@ class SentenceRetrievalProcessor(DataProcessor):
 
     def get_examples(self, file_path, purpose):
         """See base class."""
+        if is_columnar(file_path):
+            yield from self.create_examples(ColumnarRows(file_path), purpose)
+            return
         with open(file_path, "r", encoding="utf-8-sig") as f:
             lines = csv.reader(f, delimiter="\t")
-            for (i, line) in enumerate(lines):
-                guid = "%s-%d" % (purpose, i)
-                title = process_title(line[2])
-                text_a = process_sent(line[1])
-                text_b = process_evid(line[4])
-                text_b = title + " : " + text_b
-                label = process_label(line[5]) if purpose != "predict" else self.get_dummy_label()
-                yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
+            yield from self.create_examples(lines, purpose)
+
+    def create_examples(self, lines, purpose):
+        for (i, line) in enumerate(lines):
+            guid = "%s-%d" % (purpose, i)
+            title = process_title(line[2])
+            text_a = process_sent(line[1])
+            text_b = process_evid(line[4])
+            text_b = title + " : " + text_b
+            label = process_label(line[5]) if purpose != "predict" else self.get_dummy_label()
+            yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
 
     def get_length(self, file_path):
         """Return the number of examples."""
+        if is_columnar(file_path):
+            return len(ColumnarRows(file_path))
         return sum(1 for line in open(file_path, "r", encoding="utf-8-sig"))
 
     def get_labels(self):
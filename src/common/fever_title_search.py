@@ -0,0 +1,284 @@
+"""Offline search over the titles of the documents in a FeverDocDB."""
+
+import bisect
+import functools
+import heapq
+import json
+import logging
+import math
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+from urllib.request import pathname2url
+
+import nltk
+
+from common.fever_doc_db import FeverDocDB, get_db_signature
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_title(doc_id):
+    """Convert a FEVER page id (e.g. 'Savages_-LRB-band-RRB-') into the title
+    format returned by the Wikipedia search API (e.g. 'Savages (band)')."""
+    title = doc_id.replace("_", " ")
+    title = title.replace("-LRB-", "(")
+    title = title.replace("-RRB-", ")")
+    title = title.replace("-COLON-", ":")
+    return title
+
+
+def clean_title(doc_id):
+    """Strip a FEVER page id of its disambiguation and punctuation."""
+    title = unicodedata.normalize("NFD", doc_id)
+    title = re.sub("-LRB-.*?-RRB-", "", title)
+    title = re.sub("_", " ", title)
+    title = re.sub("-COLON-", ":", title)
+    title = title.replace("-", " ")
+    title = title.replace("–", " ")
+    title = title.replace(".", "")
+    return title
+
+
+def tokenize_title(text):
+    """Lowercase and strip the accents of 'text' and split it in word tokens."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r"\w+", text.lower())
+
+
+class FeverTitleSearch(object):
+    """BM25 ranked search over an inverted index of the page titles.
+
+    Since titles are short, every term is assumed to appear at most once in a
+    title, so the BM25 score of a title is its length normalization factor
+    multiplied by the sum of the idf of the query terms it contains.
+    """
+
+    # Terms that appear in more titles than this are only used to re-rank the
+    # candidates produced by the rarer terms of the query.
+    dense_term_df = 50000
+
+    def __init__(self, titles, postings, lengths, k1=1.2, b=0.75, signature=None):
+        self.titles = titles
+        self.postings = postings
+        self.lengths = lengths
+        self.signature = signature
+        self.k1 = k1
+        self.b = b
+
+        num_titles = len(self.titles)
+        avg_length = sum(self.lengths) / max(1, num_titles)
+        self.norms = array("f", (
+            (k1 + 1) / (1 + k1 * (1 - b + b * length / max(avg_length, 1e-9)))
+            for length in self.lengths
+        ))
+        self.idfs = {
+            term: math.log(1 + (num_titles - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    @classmethod
+    def build(cls, db):
+        """Build the index from the ids of the docs stored in 'db'."""
+        titles = []
+        postings = {}
+        lengths = array("H")
+        for doc_id in db.get_doc_ids():
+            tokens = tokenize_title(normalize_title(doc_id))
+            if len(tokens) == 0:
+                continue
+            index = len(titles)
+            titles.append(doc_id)
+            lengths.append(min(len(tokens), 65535))
+            for token in set(tokens):
+                if token not in postings:
+                    postings[token] = array("I")
+                postings[token].append(index)
+        return cls(titles, postings, lengths, signature=get_db_signature(db.path))
+
+    @classmethod
+    def load(cls, index_path):
+        """Load an index previously stored with 'save'."""
+        with open(index_path, "rb") as f:
+            data = pickle.load(f)
+        # Indexes saved without a signature are (titles, postings, lengths).
+        if len(data) == 3:
+            return cls(*data)
+        signature, titles, postings, lengths = data
+        return cls(titles, postings, lengths, signature=signature)
+
+    def save(self, index_path):
+        """Store the index in 'index_path'."""
+        with open(index_path + ".tmp", "wb") as f:
+            pickle.dump((self.signature, self.titles, self.postings, self.lengths), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(index_path + ".tmp", index_path)
+
+    @classmethod
+    def from_db(cls, db_path, index_path=None):
+        """Load the index stored next to 'db_path', building it if missing or
+        if it does not match the db anymore."""
+        if index_path is None:
+            index_path = os.path.splitext(db_path)[0] + ".titles.pkl"
+        if os.path.isfile(index_path):
+            logger.info("Loading title index from %s", index_path)
+            index = cls.load(index_path)
+            if index.signature == get_db_signature(db_path):
+                return index
+            logger.warning("%s does not match %s, rebuilding it", index_path, db_path)
+        logger.info("Building title index from %s", db_path)
+        with FeverDocDB(db_path) as db:
+            index = cls.build(db)
+        index.save(index_path)
+        return index
+
+    def search(self, query, results=10):
+        """Return the titles of the 'results' best matching pages for 'query'."""
+        terms = Counter(t for t in tokenize_title(query) if t in self.postings)
+        if len(terms) == 0:
+            return []
+        terms = sorted(terms.items(), key=lambda t: len(self.postings[t[0]]))
+
+        scores = {}
+        for i, (term, count) in enumerate(terms):
+            docs = self.postings[term]
+            weight = self.idfs[term] * count
+            if i == 0 or len(docs) <= self.dense_term_df:
+                for doc in docs:
+                    scores[doc] = scores.get(doc, 0.0) + weight
+            else:
+                for doc in scores:
+                    pos = bisect.bisect_left(docs, doc)
+                    if pos < len(docs) and docs[pos] == doc:
+                        scores[doc] += weight
+
+        best = heapq.nlargest(
+            results, scores.items(), key=lambda s: (s[1] * self.norms[s[0]], -s[0])
+        )
+        return [normalize_title(self.titles[doc]) for doc, _ in best]
+
+
+class TitleStemmer(object):
+    """Porter stemmer for claims and page titles that memoizes the stem of the
+    most recently seen words."""
+
+    def __init__(self, cache_size=1000000):
+        self.stemmer = nltk.PorterStemmer()
+        self.stem_word = functools.lru_cache(maxsize=cache_size)(self.stemmer.stem)
+
+    def stem(self, text):
+        """Return the stems of the lowercased tokens of 'text'."""
+        return [self.stem_word(word.lower()) for word in nltk.word_tokenize(text) if len(word) > 0]
+
+    def stem_title(self, doc_id):
+        """Return the stems of the tokens of the title of 'doc_id'."""
+        return self.stem(clean_title(doc_id))
+
+
+def stem_titles(doc_ids):
+    stemmer = TitleStemmer()
+    return [(doc_id, " ".join(stemmer.stem_title(doc_id))) for doc_id in doc_ids]
+
+
+class TitleStemsDB(object):
+    """Stemmed tokens of the page titles of a FeverDocDB, in a sqlite database.
+
+    Each thread reads from the database through its own connection, and in
+    read-only mode the database is opened as immutable and memory-mapped.
+    """
+
+    def __init__(self, path, read_only=False, mmap_size=2 ** 40):
+        self.path = path
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.connections = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def default_path(db_path):
+        return os.path.splitext(db_path)[0] + ".stems.db"
+
+    @staticmethod
+    def is_current(path, db_path):
+        """Check whether the stems stored in 'path' were built from the db at
+        'db_path' as it is now."""
+        if not os.path.isfile(path):
+            return False
+        connection = sqlite3.connect(path)
+        try:
+            row = connection.execute("SELECT value FROM metadata WHERE key = 'signature'").fetchone()
+        except sqlite3.OperationalError:
+            # Stems stored without a signature.
+            row = None
+        finally:
+            connection.close()
+        return row is not None and json.loads(row[0]) == get_db_signature(db_path)
+
+    @classmethod
+    def build(cls, db, path, pool=None, chunk_size=10000):
+        """Store the stems of the titles of all the docs in 'db' in 'path'."""
+        doc_ids = db.get_doc_ids()
+        chunks = (doc_ids[i : i + chunk_size] for i in range(0, len(doc_ids), chunk_size))
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+        connection = sqlite3.connect(path + ".tmp")
+        connection.execute("PRAGMA journal_mode=OFF")
+        connection.execute("PRAGMA synchronous=OFF")
+        connection.execute("CREATE TABLE metadata (key PRIMARY KEY, value)")
+        connection.execute("INSERT INTO metadata VALUES (?,?)", ("signature", json.dumps(get_db_signature(db.path))))
+        connection.execute("CREATE TABLE stems (id PRIMARY KEY, stems)")
+        for pairs in (pool.imap_unordered if pool is not None else map)(stem_titles, chunks):
+            connection.executemany("INSERT INTO stems VALUES (?,?)", pairs)
+        connection.commit()
+        connection.close()
+        os.replace(path + ".tmp", path)
+
+    @property
+    def connection(self):
+        """Return the connection to the database to use in the calling thread."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+
+    def connect(self):
+        if not self.read_only:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+        else:
+            uri = "file:%s?mode=ro&immutable=1" % pathname2url(os.path.abspath(self.path))
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            connection.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def close(self):
+        """Close the connections to the database."""
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+    def get_stems(self, doc_id):
+        """Return the stems of the title of 'doc_id', or None if it is unknown."""
+        cursor = self.connection.cursor()
+        norm_id = unicodedata.normalize("NFD", doc_id)
+        cursor.execute(
+            "SELECT stems FROM stems WHERE id = ?", (norm_id,),
+        )
+        result = cursor.fetchone()
+        cursor.close()
+        return result if result is None else result[0].split()
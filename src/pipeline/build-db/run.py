@@ -16,9 +16,13 @@ import os
 import sqlite3
 import unicodedata
 from multiprocessing import Pool as ProcessPool
+from multiprocessing import Queue
+from queue import Empty
 
 from tqdm import tqdm
 
+from common.fever_doc_db import COMPRESSIONS, DocCompressor, split_doc_lines
+
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -34,12 +38,19 @@ logger.addHandler(console)
 
 
 PREPROCESS_FN = None
+CHUNKS_QUEUE = None
+COMPRESSOR = None
+SPLIT_SENTENCES = False
 
 
-def init(filename):
-    global PREPROCESS_FN
+def init(filename, queue=None, compressor=None, split_sentences=False):
+    global PREPROCESS_FN, CHUNKS_QUEUE, COMPRESSOR, SPLIT_SENTENCES
     if filename:
         PREPROCESS_FN = import_module(filename).preprocess
+    CHUNKS_QUEUE = queue
+    if compressor:
+        COMPRESSOR = DocCompressor(*compressor)
+    SPLIT_SENTENCES = split_sentences
 
 
 def import_module(filename):
@@ -67,10 +78,13 @@ def iter_files(path):
         raise RuntimeError("Path %s is invalid" % path)
 
 
-def get_contents(filename):
-    """Parse the contents of a file. Each line is a JSON encoded document."""
-    global PREPROCESS_FN
+def iter_contents(filename, chunk_size=1000):
+    """Parse the contents of a file in chunks of at most `chunk_size` documents.
+    Each line is a JSON encoded document. Each chunk is a pair of lists, one
+    with the documents and one with the sentences of those documents."""
+    global PREPROCESS_FN, COMPRESSOR, SPLIT_SENTENCES
     documents = []
+    sentences = []
     with open(filename) as f:
         for line in f:
             # Parse document
@@ -81,15 +95,58 @@ def get_contents(filename):
             # Skip if it is empty or None
             if not doc:
                 continue
+            doc_id = unicodedata.normalize("NFD", doc["id"])
+            lines = doc["lines"]
+            # Maybe split the document in sentences
+            if SPLIT_SENTENCES:
+                sentences.extend(
+                    (doc_id, sent_id, text)
+                    for sent_id, text in split_doc_lines(lines)
+                )
+            # Maybe compress the text of the document
+            if COMPRESSOR:
+                lines = COMPRESSOR.compress(lines)
             # Add the document
-            documents.append(
-                (unicodedata.normalize(
-                    "NFD", doc["id"]), doc["lines"])
-            )
-    return documents
+            documents.append((doc_id, lines))
+            if len(documents) >= chunk_size:
+                yield documents, sentences
+                documents = []
+                sentences = []
+    if documents:
+        yield documents, sentences
+
+
+def stream_contents(args):
+    """Send the chunks of the contents of a file to the writer, followed by a
+    `None` once the whole file has been sent."""
+    global CHUNKS_QUEUE
+    filename, chunk_size = args
+    try:
+        for chunk in iter_contents(filename, chunk_size):
+            # Blocks while the queue is full, i.e. until the writer catches up.
+            CHUNKS_QUEUE.put(chunk)
+    finally:
+        CHUNKS_QUEUE.put(None)
+
+
+def sample_contents(files, size):
+    """Collect the text of the first documents in `files`, up to `size` bytes."""
+    samples = []
+    for filename in files:
+        for documents, _ in iter_contents(filename):
+            for _, lines in documents:
+                samples.append(lines)
+                size -= len(lines)
+                if size <= 0:
+                    return samples
+    return samples
 
 
-def store_contents(data_path, save_path, preprocess, num_workers=None):
+def store_contents(data_path, save_path, preprocess, num_workers=None,
+                   bulk_load=False, commit_every=100000, chunk_size=1000,
+                   queue_size=16, compression=None, compression_level=None,
+                   compression_dict_size=None, split_sentences=False,
+                   reader_timeout=10):
     """Preprocess and store a corpus of documents in sqlite.
 
     Args:
@@ -99,30 +156,113 @@ def store_contents(data_path, save_path, preprocess, num_workers=None):
         preprocess: Path to file defining a custom `preprocess` function. Takes
           in and outputs a structured doc.
         num_workers: Number of parallel processes to use when reading docs.
+        bulk_load: Load the docs with journaling and syncing disabled into a
+          temporary file, committing every `commit_every` docs, and index the
+          ids only once all the docs are loaded.
+        commit_every: Number of docs inserted between commits in bulk load mode.
+        chunk_size: Maximum number of docs sent at once from a reader process to
+          the writer.
+        queue_size: Maximum number of chunks waiting to be written. Readers are
+          blocked while the queue is full.
+        compression: Algorithm used to compress the text of each doc (one of
+          `zlib` or `zstd`), or None to store it as is.
+        compression_level: Compression level, or None for the default one.
+        compression_dict_size: Size of the dictionary to train on a sample of
+          the docs for zstd compression, or None to not use a dictionary.
+        split_sentences: Also store each sentence of the docs in a separate
+          table, so that readers do not have to split the docs themselves.
+        reader_timeout: Seconds to wait for a chunk before checking that the
+          readers are still alive.
     """
     if os.path.isfile(save_path):
         raise RuntimeError("%s already exists! Not overwriting." % save_path)
 
     logger.info("Reading into database...")
-    conn = sqlite3.connect(save_path)
-    c = conn.cursor()
-    c.execute("CREATE TABLE documents (id PRIMARY KEY, lines);")
+    if bulk_load:
+        # A crash would leave a corrupted db behind, so build it aside, from
+        # scratch even if an earlier build crashed.
+        if os.path.exists(save_path + ".tmp"):
+            os.remove(save_path + ".tmp")
+        conn = sqlite3.connect(save_path + ".tmp")
+        conn.execute("PRAGMA page_size = 8192;")
+        conn.execute("PRAGMA journal_mode = OFF;")
+        conn.execute("PRAGMA synchronous = OFF;")
+        conn.execute("PRAGMA locking_mode = EXCLUSIVE;")
+        conn.execute("PRAGMA cache_size = -262144;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        c = conn.cursor()
+        c.execute("CREATE TABLE documents (id, lines);")
+    else:
+        conn = sqlite3.connect(save_path)
+        c = conn.cursor()
+        c.execute("CREATE TABLE documents (id PRIMARY KEY, lines);")
+    if split_sentences:
+        c.execute("CREATE TABLE sentences (page_id, sent_id, text);")
 
-    workers = ProcessPool(num_workers, initializer=init,
-                          initargs=(preprocess,))
     files = [f for f in iter_files(data_path)]
+    compressor = None
+    if compression:
+        dictionary = None
+        if compression_dict_size:
+            logger.info("Training compression dictionary...")
+            init(preprocess)
+            samples = sample_contents(files, 100 * compression_dict_size)
+            dictionary = DocCompressor.train_dictionary(samples, compression_dict_size)
+        compressor = (compression, dictionary, compression_level)
+        c.execute("CREATE TABLE metadata (key PRIMARY KEY, value);")
+        c.execute("INSERT INTO metadata VALUES (?,?)", ("compression", compression))
+        if dictionary is not None:
+            c.execute("INSERT INTO metadata VALUES (?,?)", ("compression_dict", dictionary))
+
+    queue = Queue(queue_size)
+    workers = ProcessPool(num_workers, initializer=init,
+                          initargs=(preprocess, queue, compressor, split_sentences))
+    result = workers.map_async(
+        stream_contents, [(f, chunk_size) for f in files], chunksize=1)
+    # The pool replaces a reader that dies (e.g. killed when out of memory),
+    # but its file is then never finished, so check the readers are the same.
+    reader_pids = set(process.pid for process in workers._pool)
     count = 0
-    for pairs in tqdm(
-            workers.imap_unordered(
-                get_contents,
-                files),
-            total=len(files)):
-        count += len(pairs)
-        c.executemany("INSERT INTO documents VALUES (?,?)", pairs)
+    committed = 0
+    with tqdm(total=len(files)) as progress:
+        while progress.n < len(files):
+            try:
+                chunk = queue.get(timeout=reader_timeout)
+            except Empty:
+                if result.ready():
+                    # Raise the errors of the readers, if any.
+                    result.get()
+                    raise RuntimeError("Readers finished without sending all the files")
+                if set(process.pid for process in workers._pool) != reader_pids:
+                    workers.terminate()
+                    raise RuntimeError("A reader process died before sending all its file")
+                continue
+            if chunk is None:
+                progress.update(1)
+                continue
+            pairs, sentences = chunk
+            count += len(pairs)
+            c.executemany("INSERT INTO documents VALUES (?,?)", pairs)
+            if sentences:
+                c.executemany("INSERT INTO sentences VALUES (?,?,?)", sentences)
+            if bulk_load and count - committed >= commit_every:
+                conn.commit()
+                committed = count
+    # Raise the errors of the readers, if any.
+    result.get()
+    workers.close()
     logger.info("Read %d docs." % count)
+    if bulk_load:
+        logger.info("Indexing...")
+        c.execute("CREATE UNIQUE INDEX documents_id ON documents (id);")
+    if split_sentences:
+        logger.info("Indexing sentences...")
+        c.execute("CREATE INDEX sentences_page_id ON sentences (page_id);")
     logger.info("Committing...")
     conn.commit()
     conn.close()
+    if bulk_load:
+        os.replace(save_path + ".tmp", save_path)
 
 
 # ------------------------------------------------------------------------------
@@ -148,6 +288,53 @@ if __name__ == "__main__":
         default=None,
         help="Number of CPU processes (for tokenizing, etc)",
     )
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help="Load the docs with journaling disabled and index them at the end",
+    )
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        default=100000,
+        help="Number of docs inserted between commits when bulk loading",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Number of docs sent at once from a reader process to the writer",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=16,
+        help="Number of chunks of docs that can wait to be written",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        choices=COMPRESSIONS,
+        help="Compress the text of each doc with this algorithm",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=None,
+        help="Compression level to use",
+    )
+    parser.add_argument(
+        "--compression-dict-size",
+        type=int,
+        default=None,
+        help="Size in bytes of the dictionary trained for zstd compression",
+    )
+    parser.add_argument(
+        "--split-sentences",
+        action="store_true",
+        help="Also store the sentences of each doc in a separate table",
+    )
     args = parser.parse_args()
 
     save_dir = os.path.dirname(args.save_path)
@@ -157,4 +344,8 @@ if __name__ == "__main__":
         os.makedirs(save_dir)
 
     store_contents(args.data_path, args.save_path,
-                   args.preprocess, args.num_workers)
+                   args.preprocess, args.num_workers,
+                   args.bulk_load, args.commit_every,
+                   args.chunk_size, args.queue_size,
+                   args.compression, args.compression_level,
+                   args.compression_dict_size, args.split_sentences)
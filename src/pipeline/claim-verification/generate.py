@@ -1,18 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
-import re
-import json
 import os
 import unicodedata
 import random
 from collections import defaultdict
-from functools import reduce
 
 import numpy as np
-from tqdm import tqdm
 
-from common.fever_doc_db import FeverDocDB
+from common.fever_generate import write_rows
+from common.fever_io import ROW_FORMATS, count_lines, iter_jsonl, open_row_writer
 
 
 def get_all_sentences(docs, weighted_sentences):
@@ -26,7 +23,7 @@ def get_evidence_sentences(docs, evid_sets):
         for item in evid_set:
             Annotation_ID, Evidence_ID, Wikipedia_URL, sentence_ID = item
             if Wikipedia_URL is not None:
-                sent = docs[Wikipedia_URL][sentence_ID].split("\t")[1]
+                sent = docs[Wikipedia_URL][sentence_ID][1]
                 evidence.add((Wikipedia_URL, sentence_ID, sent))
     return evidence
 
@@ -58,41 +55,47 @@ def fetch_documents(db, evid_sets):
                 pages.add(page)
 
     docs = defaultdict(lambda: [])
-    for page, lines in db.get_all_doc_lines(pages):
-        docs[page] = re.split("\n(?=\d+)", lines)
+    for page, sentences in db.get_all_doc_sentences(pages):
+        docs[page] = sentences
     return docs
 
 
-def main(db_file, in_file, out_file, prediction=None):
+def write_claim(rows, line, docs, prediction=None):
+    id = line["id"]
+    claim = line["claim"]
+    evid_sets = line.get("evidence", [])
+    weighted_sentences = line["predicted_sentences"]
+
+    if prediction:
+        # extract all the sentences predicted for this claim
+        for page, sent_id, sentence in get_all_sentences(docs, weighted_sentences):
+            rows.append([str(id), claim, page, str(sent_id), sentence])
+    else:
+        label = line["label"]
+        # write positive and negative evidence to file
+        for page, sent_id, sentence in get_evidence_sentences(docs, evid_sets):
+            rows.append([str(id), claim, page, str(sent_id), sentence, label[0]])
+        for page, sent_id, sentence in get_non_evidence_sentences(docs, evid_sets, weighted_sentences):
+            rows.append([str(id), claim, page, str(sent_id), sentence, "NOT ENOUGH INFO"[0]])
+
+
+def write_claims(rows, db, lines, prediction=None):
+    for line in lines:
+        docs = fetch_documents(db, line.get("evidence", []))
+        write_claim(rows, line, docs, prediction=prediction)
+
+
+def main(db_file, in_file, out_file, prediction=None, db_cache_size=0, num_workers=None, shard_size=128, out_format="tsv"):
+    kwargs = dict(prediction=prediction)
     path = os.getcwd()
-    outfile = open(os.path.join(path, out_file), "w+")
-
-    db = FeverDocDB(db_file)
-
-    with open(os.path.join(path, in_file), "r") as f:
-        nlines = reduce(lambda a, b: a + b, map(lambda x: 1, f.readlines()), 0)
-        f.seek(0)
-        lines = map(json.loads, f.readlines())
-        for line in tqdm(lines, total=nlines):
-            id = line["id"]
-            claim = line["claim"]
-            evid_sets = line.get("evidence", [])
-            weighted_sentences = line["predicted_sentences"]
-
-            docs = fetch_documents(db, evid_sets)
-
-            if prediction:
-                # extract all the sentences predicted for this claim
-                for page, sent_id, sentence in get_all_sentences(docs, weighted_sentences):
-                    outfile.write("\t".join([str(id), claim, page, str(sent_id), sentence]) + "\n")
-            else:
-                label = line["label"]
-                # write positive and negative evidence to file
-                for page, sent_id, sentence in get_evidence_sentences(docs, evid_sets):
-                    outfile.write("\t".join([str(id), claim, page, str(sent_id), sentence, label[0]]) + "\n")
-                for page, sent_id, sentence in get_non_evidence_sentences(docs, evid_sets, weighted_sentences):
-                    outfile.write("\t".join([str(id), claim, page, str(sent_id), sentence, "NOT ENOUGH INFO"[0]]) + "\n")
-    outfile.close()
+    writer = open_row_writer(os.path.join(path, out_file), out_format)
+
+    in_path = os.path.join(path, in_file)
+    nlines = count_lines(in_path)
+    lines = iter_jsonl(in_path)
+    write_rows(writer, write_claims, db_file, lines, nlines, db_cache_size=db_cache_size, num_workers=num_workers,
+               shard_size=shard_size, **kwargs)
+    writer.close()
 
 
 if __name__ == "__main__":
@@ -104,5 +107,14 @@ if __name__ == "__main__":
                         help="path to save output dataset")
     parser.add_argument("--prediction", action='store_true',
                         help="when set it generate all the sentences of the prediceted documents")
+    parser.add_argument("--db-cache-size", type=int, default=0,
+                        help="size in bytes of the cache of the wiki pages read from the database (0 to disable it)")
+    parser.add_argument("--num-workers", type=int, default=None,
+                        help="when set the claims are processed by this number of worker processes")
+    parser.add_argument("--shard-size", type=int, default=128,
+                        help="number of claims given to a worker process at a time")
+    parser.add_argument("--out-format", type=str, default="tsv", choices=ROW_FORMATS,
+                        help="format of the output dataset, either a tsv file or a directory of memory-mappable columns")
     args = parser.parse_args()
-    main(args.db_file, args.in_file, args.out_file, prediction=args.prediction)
+    main(args.db_file, args.in_file, args.out_file, prediction=args.prediction, db_cache_size=args.db_cache_size,
+         num_workers=args.num_workers, shard_size=args.shard_size, out_format=args.out_format)
@@ -2,28 +2,30 @@
 
 import argparse
 import bisect
-import csv
 import json
 import os
 
 from collections import defaultdict
-from functools import reduce
 
 from tqdm import tqdm
 
+from common.fever_io import count_lines, count_rows, iter_jsonl, iter_predicted_rows, iter_tsv
 
-def get_classified_sentences(labels_file):
+
+def get_classified_sentences(labels_file, sentences_file=None, predictions_file=None):
     claim_labels = defaultdict(lambda: [])
     label_map = ["REFUTES", "SUPPORTS", "NOT ENOUGH INFO"]
-    with open(labels_file, "r") as f:
-        nlines = reduce(lambda a, b: a + b, map(lambda x: 1, f.readlines()), 0)
-        f.seek(0)
-        lines = csv.reader(f, delimiter="\t")
-        for line in tqdm(lines, desc="Label", total=nlines):
-            claim_id, claim, page, sent_id, sent, label = line
-            claim_id, sent_id, label = int(claim_id), int(sent_id), label_map[int(label)]
-            evid = (page, sent_id, sent)
-            claim_labels[claim_id].append((label, evid))
+    if labels_file is not None:
+        nlines = count_lines(labels_file)
+        lines = iter_tsv(labels_file)
+    else:
+        nlines = count_rows(sentences_file)
+        lines = iter_predicted_rows(sentences_file, predictions_file)
+    for line in tqdm(lines, desc="Label", total=nlines):
+        claim_id, claim, page, sent_id, sent, label = line
+        claim_id, sent_id, label = int(claim_id), int(sent_id), label_map[int(label)]
+        evid = (page, sent_id, sent)
+        claim_labels[claim_id].append((label, evid))
     return claim_labels
 
 
@@ -47,31 +49,39 @@ def predict_claim(classified_sentences):
     return {"predicted_label": prediction[0], "predicted_evidence": prediction[1]}
 
 
-def main(labels_file, in_file, out_file):
+def main(labels_file, in_file, out_file, sentences_file=None, predictions_file=None):
     path = os.getcwd()
-    labels_file = os.path.join(path, labels_file)
+    if labels_file is not None:
+        labels_file = os.path.join(path, labels_file)
+    else:
+        sentences_file = os.path.join(path, sentences_file)
+        predictions_file = os.path.join(path, predictions_file)
     in_file = os.path.join(path, in_file)
     out_file = os.path.join(path, out_file)
 
-    classified_sentences = get_classified_sentences(labels_file)
+    classified_sentences = get_classified_sentences(labels_file, sentences_file, predictions_file)
 
     with open(out_file, "w+") as fout:
-        with open(in_file, "r") as fin:
-            nlines = reduce(lambda a, b: a + b, map(lambda x: 1, fin.readlines()), 0)
-            fin.seek(0)
-            lines = map(json.loads, fin.readlines())
-            for line in tqdm(lines, desc="Claim", total=nlines):
-                claim_id = line["id"]
-                line["classified_sentences"] = classified_sentences[claim_id]
-                line.update(predict_claim(classified_sentences[claim_id]))
-                fout.write(json.dumps(line) + "\n")
+        nlines = count_lines(in_file)
+        lines = iter_jsonl(in_file)
+        for line in tqdm(lines, desc="Claim", total=nlines):
+            claim_id = line["id"]
+            line["classified_sentences"] = classified_sentences[claim_id]
+            line.update(predict_claim(classified_sentences[claim_id]))
+            fout.write(json.dumps(line) + "\n")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--labels-file", type=str)
+    parser.add_argument("--labels-file", type=str,
+                        help="tsv file of the sentences to label the claims with, each followed by its label")
+    parser.add_argument("--sentences-file", type=str,
+                        help="sentences to label the claims with, as a tsv file or a directory of columns, when no labels file is given")
+    parser.add_argument("--predictions-file", type=str,
+                        help="labels of the sentences of the sentences file, one per line")
     parser.add_argument("--in-file", type=str, help="input dataset")
     parser.add_argument("--out-file", type=str,
                         help="path to save output dataset")
     args = parser.parse_args()
-    main(args.labels_file, args.in_file, args.out_file)
+    main(args.labels_file, args.in_file, args.out_file,
+         sentences_file=args.sentences_file, predictions_file=args.predictions_file)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+from multiprocessing import Pool as ProcessPool
+
+import nltk
+
+from common.fever_doc_db import FeverDocDB
+from common.fever_title_search import FeverTitleSearch, TitleStemsDB
+
+
+def main(db_file, num_workers=None):
+    path = os.getcwd()
+    db_file = os.path.join(path, db_file)
+
+    print("Building the index of the titles...")
+    FeverTitleSearch.from_db(db_file)
+
+    with FeverDocDB(db_file) as db:
+        print("Building the sorted list of the titles...")
+        db.get_titles()
+
+        stems_file = TitleStemsDB.default_path(db_file)
+        if not TitleStemsDB.is_current(stems_file, db_file):
+            print("Stemming the titles...")
+            with ProcessPool(num_workers) as pool:
+                TitleStemsDB.build(db, stems_file, pool)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db-file", type=str,
+                        help="database file which contains wiki pages")
+    parser.add_argument("--num-workers", type=int, default=None,
+                        help="number of processes used to stem the titles")
+    args = parser.parse_args()
+
+    nltk.download("punkt", quiet=True)
+
+    main(args.db_file, args.num_workers)
@@ -9,11 +9,12 @@
 # https://github.com/UKPLab/fever-2018-team-athene/blob/master/LICENSE.txt
 
 import argparse
+import functools
 import json
 import os
-import re
 import time
 import unicodedata
+from multiprocessing import Pool as ProcessPool
 from multiprocessing.pool import ThreadPool
 
 import nltk
@@ -21,31 +22,182 @@ import wikipedia
 from allennlp.predictors import Predictor
 from tqdm import tqdm
 
+from common.fever_cache import PersistentCache
 from common.fever_doc_db import FeverDocDB
+from common.fever_title_search import FeverTitleSearch, TitleStemmer, TitleStemsDB
 
 
-def processed_line(method, line):
-    nps, wiki_results, pages = method.exact_match(line)
+def processed_line(method, line, noun_phrases=None):
+    nps, wiki_results, pages = method.exact_match(line, noun_phrases)
     line["noun_phrases"] = nps
     line["predicted_pages"] = pages
     line["wiki_results"] = wiki_results
     return line
 
 
-def process_line_with_progress(method, line, progress=None):
-    if progress is not None and line["id"] in progress:
-        return progress[line["id"]]
-    else:
-        return processed_line(method, line)
+def process_lines(method, lines, map_function, parse_batch_size=None):
+    if parse_batch_size is None:
+        yield from map_function(lambda l: processed_line(method, l), lines)
+        return
+    # Parse a window of claims at a time so that the parser can group claims of
+    # similar length in the same batch.
+    window_size = parse_batch_size * 8
+    for start in range(0, len(lines), window_size):
+        window = lines[start : start + window_size]
+        noun_phrases = method.get_noun_phrases_batch(window, parse_batch_size)
+        yield from map_function(lambda a: processed_line(method, *a), zip(window, noun_phrases))
+
+
+WORKER_METHOD = None
+
+
+def init_worker(method_kwargs, shared_indexes):
+    global WORKER_METHOD
+    WORKER_METHOD = Doc_Retrieval(**method_kwargs, **shared_indexes)
+
+
+def load_shared_indexes(database_path, search_backend="wikipedia", title_index=False, **kwargs):
+    """Build or load once the indexes of the titles used by all the workers,
+    instead of each worker loading, or building, its own copy."""
+    shared_indexes = {}
+    if search_backend == "local":
+        shared_indexes["title_search"] = FeverTitleSearch.from_db(database_path)
+    if title_index:
+        with FeverDocDB(database_path) as db:
+            shared_indexes["titles"] = db.get_titles()
+    return shared_indexes
+
+
+def process_shard(args):
+    lines, parse_batch_size = args
+    return list(process_lines(WORKER_METHOD, lines, map, parse_batch_size))
+
+
+def process_shards(pool, lines, parse_batch_size=None, shard_size=128):
+    # Each worker owns its own Doc_Retrieval and processes a shard of claims at
+    # a time; imap returns the shards in the same order they were given.
+    shards = (lines[i : i + shard_size] for i in range(0, len(lines), shard_size))
+    for shard in pool.imap(process_shard, ((shard, parse_batch_size) for shard in shards)):
+        yield from shard
+
+
+class ProgressJournal:
+    """Append-only JSONL file of the processed claims, used to resume a run."""
+
+    def __init__(self, path, sync_every=100):
+        self.path = path
+        self.sync_every = sync_every
+        self.offsets = {}
+        self.unsynced = 0
+        if os.path.isfile(self.path):
+            self.load()
+        self.writer = open(self.path, "ab")
+        self.reader = open(self.path, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, claim_id):
+        return claim_id in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def load(self):
+        """Index the offset of each claim, dropping a partially written tail."""
+        end = 0
+        with open(self.path, "rb") as f:
+            for entry in f:
+                if not entry.endswith(b"\n"):
+                    break
+                try:
+                    claim_id = json.loads(entry)["id"]
+                except ValueError:
+                    break
+                self.offsets[claim_id] = end
+                end += len(entry)
+        os.truncate(self.path, end)
+
+    def append(self, line):
+        self.offsets[line["id"]] = self.writer.tell()
+        self.writer.write((json.dumps(line) + "\n").encode("utf-8"))
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.unsynced = 0
+
+    def read(self, claim_id):
+        """Return the JSON encoded line of 'claim_id' as stored in the journal."""
+        self.reader.seek(self.offsets[claim_id])
+        return self.reader.readline().decode("utf-8")
+
+    def close(self):
+        self.sync()
+        self.writer.close()
+        self.reader.close()
+
+
+def wikipedia_search(query):
+    i = 1
+    while i < 12:
+        try:
+            return wikipedia.search(query)
+        except (
+            ConnectionResetError,
+            ConnectionError,
+            ConnectionAbortedError,
+            ConnectionRefusedError,
+        ):
+            print("Connection reset error received! Trial #" + str(i))
+            time.sleep(600 * i)
+            i += 1
+    return None
+
+
+MISSING = object()
+
+
+SEARCH_BACKENDS = {
+    "wikipedia": lambda database_path: wikipedia_search,
+    "local": lambda database_path: FeverTitleSearch.from_db(database_path).search,
+}
 
 
 class Doc_Retrieval:
-    def __init__(self, database_path, add_claim=False, max_pages_per_query=None):
-        self.db = FeverDocDB(database_path)
+    def __init__(self, database_path, add_claim=False, max_pages_per_query=None, search_backend="wikipedia",
+                 cache_file=None, cache_size=100000, title_index=False, read_only=False, title_search=None,
+                 titles=None):
+        self.db = FeverDocDB(database_path, title_index=title_index, read_only=read_only)
+        if titles is not None:
+            self.db.titles = titles
+        elif title_index:
+            # Load the titles once, before the threads of the pool need them.
+            self.db.get_titles()
         self.add_claim = add_claim
         self.max_pages_per_query = max_pages_per_query
-        self.proter_stemm = nltk.PorterStemmer()
-        self.tokenizer = nltk.word_tokenize
+        self.search_backend = search_backend
+        if search_backend == "local" and title_search is not None:
+            self.search = title_search.search
+        else:
+            self.search = SEARCH_BACKENDS[search_backend](database_path)
+        self.cache = PersistentCache(cache_file, cache_size) if cache_file is not None else None
+        self.stemmer = TitleStemmer()
+        # Use the stems of the titles precomputed by index.py, if available
+        # and built from this version of the db.
+        stems_path = TitleStemsDB.default_path(database_path)
+        self.title_stems = None
+        if TitleStemsDB.is_current(stems_path, database_path):
+            self.title_stems = TitleStemsDB(stems_path, read_only=read_only)
+        elif os.path.isfile(stems_path):
+            print("Ignoring " + stems_path + " as it does not match " + database_path + ", run index.py to rebuild it.")
+        self.get_title_stems = functools.lru_cache(maxsize=1000000)(self.title_stems_of)
         self.predictor = Predictor.from_path(
             "https://s3-us-west-2.amazonaws.com/allennlp/models/elmo-constituency-parser-2018.03.14.tar.gz"
         )
@@ -88,6 +240,21 @@ class Doc_Retrieval:
     def get_noun_phrases(self, line):
         claim = line["claim"]
         tokens = self.predictor.predict(claim)
+        return self.get_noun_phrases_from_parse(claim, tokens)
+
+    def get_noun_phrases_batch(self, lines, batch_size):
+        claims = [line["claim"] for line in lines]
+        # Sort the claims by length to minimize the padding inside each batch.
+        order = sorted(range(len(claims)), key=lambda i: len(claims[i]))
+        noun_phrases = [None] * len(claims)
+        for start in range(0, len(order), batch_size):
+            batch = order[start : start + batch_size]
+            outputs = self.predictor.predict_batch_json([{"sentence": claims[i]} for i in batch])
+            for i, tokens in zip(batch, outputs):
+                noun_phrases[i] = self.get_noun_phrases_from_parse(claims[i], tokens)
+        return noun_phrases
+
+    def get_noun_phrases_from_parse(self, claim, tokens):
         nps = []
         tree = tokens["hierplane_tree"]["root"]
         noun_phrases = self.get_NP(tree, nps)
@@ -99,90 +266,101 @@ class Doc_Retrieval:
             noun_phrases.append(claim)
         return list(set(noun_phrases))
 
-    def get_doc_for_claim(self, noun_phrases):
-        predicted_pages = []
-        for np in noun_phrases:
-            if len(np) > 300:
-                continue
-            i = 1
-            while i < 12:
-                try:
-                    docs = wikipedia.search(np)
-                    if self.max_pages_per_query is not None:
-                        predicted_pages.extend(docs[: self.max_pages_per_query])
-                    else:
-                        predicted_pages.extend(docs)
-                except (
-                    ConnectionResetError,
-                    ConnectionError,
-                    ConnectionAbortedError,
-                    ConnectionRefusedError,
-                ):
-                    print("Connection reset error received! Trial #" + str(i))
-                    time.sleep(600 * i)
-                    i += 1
-                else:
-                    break
-
-            # sleep_num = random.uniform(0.1,0.7)
-            # time.sleep(sleep_num)
-        predicted_pages = set(predicted_pages)
+    def get_cached(self, kind, np, compute, cache_none=True):
+        """Return 'compute(np)', memoized in the cache if there is one.
+
+        With a cache, 'np' is stripped and NFC normalized first, so that the
+        value is computed from the same string as its key.
+        """
+        if self.cache is None:
+            return compute(np)
+        np = unicodedata.normalize("NFC", np.strip())
+        key = kind + "\t" + np
+        value = self.cache.get(key, MISSING)
+        if value is MISSING:
+            value = compute(np)
+            if value is not None or cache_none:
+                self.cache.put(key, value)
+        return value
+
+    def search_pages(self, np):
+        if len(np) > 300:
+            return []
+        docs = self.search(np)
+        if docs is None:
+            return None
         processed_pages = []
-        for page in predicted_pages:
+        for page in docs:
             page = page.replace(" ", "_")
             page = page.replace("(", "-LRB-")
             page = page.replace(")", "-RRB-")
             page = page.replace(":", "-COLON-")
             processed_pages.append(page)
-
         return processed_pages
 
+    def concatenated_page(self, np):
+        page = np.replace("( ", "-LRB-")
+        page = page.replace(" )", "-RRB-")
+        page = page.replace(" - ", "-")
+        page = page.replace(" :", "-COLON-")
+        page = page.replace(" ,", ",")
+        page = page.replace(" 's", "'s")
+        page = page.replace(" ", "_")
+
+        if len(page) < 1:
+            return None
+        if not self.db.has_doc(page):
+            return None
+        return page
+
+    def get_doc_for_claim(self, noun_phrases):
+        predicted_pages = []
+        for np in noun_phrases:
+            # Failed searches are not cached so that they are retried next time.
+            docs = self.get_cached("search-" + self.search_backend, np, self.search_pages, cache_none=False) or []
+            if self.max_pages_per_query is not None:
+                predicted_pages.extend(docs[: self.max_pages_per_query])
+            else:
+                predicted_pages.extend(docs)
+
+            # sleep_num = random.uniform(0.1,0.7)
+            # time.sleep(sleep_num)
+        return list(set(predicted_pages))
+
     def np_conc(self, noun_phrases):
         noun_phrases = set(noun_phrases)
         predicted_pages = []
         for np in noun_phrases:
-            page = np.replace("( ", "-LRB-")
-            page = page.replace(" )", "-RRB-")
-            page = page.replace(" - ", "-")
-            page = page.replace(" :", "-COLON-")
-            page = page.replace(" ,", ",")
-            page = page.replace(" 's", "'s")
-            page = page.replace(" ", "_")
-
-            if len(page) < 1:
-                continue
-            doc_lines = self.db.get_doc_lines(page)
-            if doc_lines is not None:
+            page = self.get_cached("page", np, self.concatenated_page)
+            if page is not None:
                 predicted_pages.append(page)
         return predicted_pages
 
-    def exact_match(self, line):
-        noun_phrases = self.get_noun_phrases(line)
+    def title_stems_of(self, page):
+        stems = None
+        if self.title_stems is not None:
+            stems = self.title_stems.get_stems(page)
+        if stems is None:
+            stems = self.stemmer.stem_title(page)
+        return frozenset(stems)
+
+    def exact_match(self, line, noun_phrases=None):
+        if noun_phrases is None:
+            noun_phrases = self.get_noun_phrases(line)
         wiki_results = self.get_doc_for_claim(noun_phrases)
         wiki_results = list(set(wiki_results))
 
         claim = unicodedata.normalize("NFD", line["claim"])
         claim = claim.replace(".", "")
         claim = claim.replace("-", " ")
-        words = [self.proter_stemm.stem(word.lower()) for word in self.tokenizer(claim)]
-        words = set(words)
+        words = set(self.stemmer.stem(claim))
         predicted_pages = self.np_conc(noun_phrases)
 
         for page in wiki_results:
             page = unicodedata.normalize("NFD", page)
-            processed_page = re.sub("-LRB-.*?-RRB-", "", page)
-            processed_page = re.sub("_", " ", processed_page)
-            processed_page = re.sub("-COLON-", ":", processed_page)
-            processed_page = processed_page.replace("-", " ")
-            processed_page = processed_page.replace("–", " ")
-            processed_page = processed_page.replace(".", "")
-            page_words = [
-                self.proter_stemm.stem(word.lower())
-                for word in self.tokenizer(processed_page)
-                if len(word) > 0
-            ]
-
-            if all([item in words for item in page_words]):
+            page_words = self.get_title_stems(page)
+
+            if page_words <= words:
                 if ":" in page:
                     page = page.replace(":", "-COLON-")
                 predicted_pages.append(page)
@@ -202,46 +380,47 @@ def get_map_function(parallel, p=None):
     return p.imap_unordered if parallel else map
 
 
-def main(db_file, max_pages_per_query, in_file, out_file, add_claim=True, parallel=True):
-    method = Doc_Retrieval(
-        database_path=db_file, add_claim=add_claim, max_pages_per_query=max_pages_per_query
+def main(db_file, max_pages_per_query, in_file, out_file, add_claim=True, parallel=True, search_backend="wikipedia",
+         parse_batch_size=None, num_workers=None, shard_size=128, sync_every=100, cache_file=None, cache_size=100000,
+         title_index=False, read_only=False):
+    method_kwargs = dict(
+        database_path=db_file, add_claim=add_claim, max_pages_per_query=max_pages_per_query,
+        search_backend=search_backend, cache_file=cache_file, cache_size=cache_size, title_index=title_index,
+        read_only=read_only,
     )
-    processed = dict()
     path = os.getcwd()
     lines = []
     with open(os.path.join(path, in_file), "r") as f:
         lines = [json.loads(line) for line in f.readlines()]
-    if os.path.isfile(os.path.join(path, out_file + ".progress")):
-        with open(os.path.join(path, out_file + ".progress"), "rb") as f_progress:
-            import pickle
-
-            progress = pickle.load(f_progress)
-            print(
-                os.path.join(path, out_file + ".progress")
-                + " exists. Load it as progress file."
-            )
-    else:
-        progress = dict()
-
-    try:
-        with ThreadPool(processes=4 if parallel else None) as p:
-            for line in tqdm(
-                get_map_function(parallel, p)(
-                    lambda l: process_line_with_progress(method, l, progress), lines
-                ),
-                total=len(lines),
-            ):
-                processed[line["id"]] = line
-                progress[line["id"]] = line
-                # time.sleep(0.5)
+
+    with ProgressJournal(os.path.join(path, out_file + ".journal"), sync_every) as journal:
+        legacy_progress_file = os.path.join(path, out_file + ".progress")
+        if len(journal) == 0 and os.path.isfile(legacy_progress_file):
+            with open(legacy_progress_file, "rb") as f_progress:
+                import pickle
+
+                for line in pickle.load(f_progress).values():
+                    journal.append(line)
+        if len(journal) > 0:
+            print(journal.path + " exists. Resuming from " + str(len(journal)) + " processed claims.")
+        pending = [line for line in lines if line["id"] not in journal]
+
+        if num_workers is None:
+            method = Doc_Retrieval(**method_kwargs)
+            pool = ThreadPool(processes=4 if parallel else None)
+            results = process_lines(method, pending, get_map_function(parallel, pool), parse_batch_size)
+        else:
+            shared_indexes = load_shared_indexes(**method_kwargs)
+            pool = ProcessPool(num_workers, initializer=init_worker, initargs=(method_kwargs, shared_indexes))
+            results = process_shards(pool, pending, parse_batch_size, shard_size)
+
+        with pool:
+            for line in tqdm(results, initial=len(lines) - len(pending), total=len(lines)):
+                journal.append(line)
+        journal.sync()
         with open(os.path.join(path, out_file), "w+") as f2:
             for line in lines:
-                f2.write(json.dumps(processed[line["id"]]) + "\n")
-    finally:
-        with open(os.path.join(path, out_file + ".progress"), "wb") as f_progress:
-            import pickle
-
-            pickle.dump(progress, f_progress, pickle.HIGHEST_PROTOCOL)
+                f2.write(journal.read(line["id"]))
 
 
 if __name__ == "__main__":
@@ -255,6 +434,25 @@ if __name__ == "__main__":
                         help="first k pages for wiki search")
     parser.add_argument("--parallel", type=bool, default=True)
     parser.add_argument("--add-claim", type=bool, default=True)
+    parser.add_argument("--search-backend", type=str, default="wikipedia",
+                        choices=sorted(SEARCH_BACKENDS.keys()),
+                        help="where to search the pages of the noun phrases: the online wikipedia api or a local index of the titles in the database")
+    parser.add_argument("--parse-batch-size", type=int, default=None,
+                        help="when set the claims are parsed in batches of this size instead of one at a time")
+    parser.add_argument("--num-workers", type=int, default=None,
+                        help="when set the claims are processed by this many processes, each with its own model and database connection")
+    parser.add_argument("--shard-size", type=int, default=128,
+                        help="number of claims given to a worker process at a time")
+    parser.add_argument("--sync-every", type=int, default=100,
+                        help="number of processed claims after which the progress journal is flushed to disk")
+    parser.add_argument("--cache-file", type=str, default=None,
+                        help="when set the pages found for each noun phrase are cached in this database and reused across runs")
+    parser.add_argument("--cache-size", type=int, default=100000,
+                        help="number of noun phrases of the cache kept in memory")
+    parser.add_argument("--title-index", action="store_true",
+                        help="when set the existence of pages is checked against an in-memory index of the titles in the database")
+    parser.add_argument("--read-only", action="store_true",
+                        help="when set the database is opened read-only and memory-mapped, with one connection per thread")
     args = parser.parse_args()
 
     nltk.download("punkt", quiet=True)
@@ -266,4 +464,13 @@ if __name__ == "__main__":
         args.out_file,
         args.add_claim,
         args.parallel,
+        args.search_backend,
+        args.parse_batch_size,
+        args.num_workers,
+        args.shard_size,
+        args.sync_every,
+        args.cache_file,
+        args.cache_size,
+        args.title_index,
+        args.read_only,
     )
@@ -1,18 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
-import re
-import json
 import os
 import unicodedata
 import random
 from collections import defaultdict
-from functools import reduce
 
 import numpy as np
-from tqdm import tqdm
 
-from common.fever_doc_db import FeverDocDB
+from common.fever_generate import write_rows
+from common.fever_io import ROW_FORMATS, count_lines, iter_chunks, iter_jsonl, open_row_writer
 
 
 def get_all_sentences(docs, pages):
@@ -26,7 +23,7 @@ def get_evidence_sentences(docs, evid_sets):
     for evid_set in evid_sets:
         for item in evid_set:
             Annotation_ID, Evidence_ID, Wikipedia_URL, sentence_ID = item
-            sent = docs[Wikipedia_URL][sentence_ID].split("\t")[1]
+            sent = docs[Wikipedia_URL][sentence_ID][1]
             evidences.add((Wikipedia_URL, sentence_ID, sent))
     return evidences
 
@@ -57,11 +54,9 @@ def get_non_evidence_sentences(docs, evid_sets, pred_pages, max_non_evidence_per
 
 def sample_evidences(docs, page, to_ignore=set(), num_samples=1):
     evidences = []
-    for sent in docs[page]:
-        sent = sent.split("\t")
-        if len(sent) < 2:
+    for sent_id, sent_text in docs[page]:
+        if sent_text is None:
             continue
-        sent_id, sent_text = sent[0], sent[1]
         if len(sent_text.strip()) == 0:
             continue
         if sent_id in to_ignore:
@@ -70,53 +65,66 @@ def sample_evidences(docs, page, to_ignore=set(), num_samples=1):
     return evidences if num_samples is None else random.sample(evidences, min(len(evidences), num_samples))
 
 
-def fetch_documents(db, evid_sets, pred_pages):
+def get_pages(evid_sets, pred_pages):
     pages = set(pred_pages)
     for evid_set in evid_sets:
         for item in evid_set:
             _, _, page, _ = item
             if page is not None:
                 pages.add(page)
+    return pages
 
+
+def fetch_documents(db, pages):
     docs = defaultdict(lambda: [])
-    for page, lines in db.get_all_doc_lines(pages):
-        docs[page] = re.split("\n(?=\d+)", lines)
+    for page, sentences in db.iter_doc_sentences(pages):
+        docs[page] = sentences
     return docs
 
 
-def main(db_file, in_file, out_file, max_non_evidence_per_page=None, prediction=None):
+def write_claim(rows, line, docs, max_non_evidence_per_page=None, prediction=None):
+    id = line["id"]
+    claim = line["claim"]
+    evid_sets = line.get("evidence", [])
+    pred_pages = line["predicted_pages"]
+
+    if prediction:
+        # extract all the sentences for the documents predicted for this claim
+        for page, sent_id, sentence in get_all_sentences(docs, pred_pages):
+            rows.append([str(id), claim, page, str(sent_id), sentence])
+    else:
+        # write positive and negative evidence examples to file
+        for page, sent_id, sentence in get_evidence_sentences(docs, evid_sets):
+            rows.append([str(id), claim, page, str(sent_id), sentence, "1"])
+        for page, sent_id, sentence in get_non_evidence_sentences(docs, evid_sets, pred_pages, max_non_evidence_per_page=max_non_evidence_per_page):
+            rows.append([str(id), claim, page, str(sent_id), sentence, "0"])
+
+
+def write_claims(rows, db, lines, max_non_evidence_per_page=None, prediction=None, window_size=1):
+    # if not verifiable, we don't have evidence and just continue
+    lines = (line for line in lines if prediction or line["verifiable"] != "NOT VERIFIABLE")
+    # fetch at once the pages of all the claims of a window
+    for window in iter_chunks(lines, window_size):
+        pages = set()
+        for line in window:
+            pages.update(get_pages(line.get("evidence", []), line["predicted_pages"]))
+        docs = fetch_documents(db, pages)
+        for line in window:
+            write_claim(rows, line, docs, max_non_evidence_per_page=max_non_evidence_per_page, prediction=prediction)
+
+
+def main(db_file, in_file, out_file, max_non_evidence_per_page=None, prediction=None, db_cache_size=0, window_size=1,
+         num_workers=None, shard_size=128, out_format="tsv"):
+    kwargs = dict(max_non_evidence_per_page=max_non_evidence_per_page, prediction=prediction, window_size=window_size)
     path = os.getcwd()
-    outfile = open(os.path.join(path, out_file), "w+")
-
-    db = FeverDocDB(db_file)
-
-    with open(os.path.join(path, in_file), "r") as f:
-        nlines = reduce(lambda a, b: a + b, map(lambda x: 1, f.readlines()), 0)
-        f.seek(0)
-        lines = map(json.loads, f.readlines())
-        for line in tqdm(lines, total=nlines):
-            # if not verifiable, we don't have evidence and just continue
-            if not prediction and line["verifiable"] == "NOT VERIFIABLE":
-                continue
-
-            id = line["id"]
-            claim = line["claim"]
-            evid_sets = line.get("evidence", [])
-            pred_pages = line["predicted_pages"]
-
-            docs = fetch_documents(db, evid_sets, pred_pages)
-
-            if prediction:
-                # extract all the sentences for the documents predicted for this claim
-                for page, sent_id, sentence in get_all_sentences(docs, pred_pages):
-                    outfile.write("\t".join([str(id), claim, page, str(sent_id), sentence]) + "\n")
-            else:
-                # write positive and negative evidence examples to file
-                for page, sent_id, sentence in get_evidence_sentences(docs, evid_sets):
-                    outfile.write("\t".join([str(id), claim, page, str(sent_id), sentence, "1"]) + "\n")
-                for page, sent_id, sentence in get_non_evidence_sentences(docs, evid_sets, pred_pages, max_non_evidence_per_page=max_non_evidence_per_page):
-                    outfile.write("\t".join([str(id), claim, page, str(sent_id), sentence, "0"]) + "\n")
-    outfile.close()
+    writer = open_row_writer(os.path.join(path, out_file), out_format)
+
+    in_path = os.path.join(path, in_file)
+    nlines = count_lines(in_path)
+    lines = iter_jsonl(in_path)
+    write_rows(writer, write_claims, db_file, lines, nlines, db_cache_size=db_cache_size, num_workers=num_workers,
+               shard_size=shard_size, **kwargs)
+    writer.close()
 
 
 if __name__ == "__main__":
@@ -130,5 +138,16 @@ if __name__ == "__main__":
                         help="number of negative evidance to in each of the page that are relevant for a claim")
     parser.add_argument("--prediction", action='store_true',
                         help="when set it generate all the sentences of the prediceted documents")
+    parser.add_argument("--db-cache-size", type=int, default=0,
+                        help="size in bytes of the cache of the wiki pages read from the database (0 to disable it)")
+    parser.add_argument("--window-size", type=int, default=1,
+                        help="number of claims whose pages are fetched from the database at once")
+    parser.add_argument("--num-workers", type=int, default=None,
+                        help="when set the claims are processed by this number of worker processes")
+    parser.add_argument("--shard-size", type=int, default=128,
+                        help="number of claims given to a worker process at a time")
+    parser.add_argument("--out-format", type=str, default="tsv", choices=ROW_FORMATS,
+                        help="format of the output dataset, either a tsv file or a directory of memory-mappable columns")
     args = parser.parse_args()
-    main(args.db_file, args.in_file, args.out_file, max_non_evidence_per_page=args.max_non_evidence_per_page, prediction=args.prediction)
+    main(args.db_file, args.in_file, args.out_file, max_non_evidence_per_page=args.max_non_evidence_per_page, prediction=args.prediction, db_cache_size=args.db_cache_size, window_size=args.window_size,
+         num_workers=args.num_workers, shard_size=args.shard_size, out_format=args.out_format)
@@ -1,61 +1,52 @@
 #!/usr/bin/env python3
 
 import argparse
-import bisect
-import csv
-import json
 import os
-from collections import defaultdict
-from functools import reduce
 
 from tqdm import tqdm
 
+from common.fever_evidence import select_best_evidence, write_predicted_sentences
+from common.fever_io import count_lines, count_rows, iter_predicted_rows, iter_tsv
 
-def get_best_evidence(scores_file, max_sentences_per_claim):
-    weighted_claim_evidence = defaultdict(lambda: [])
-    with open(scores_file, "r") as f:
-        nlines = reduce(lambda a, b: a + b, map(lambda x: 1, f.readlines()), 0)
-        f.seek(0)
-        lines = csv.reader(f, delimiter="\t")
-        for line in tqdm(lines, desc="Score", total=nlines):
-            claim_id, claim, page, sent_id, sent, score = line
-            claim_id, sent_id, score = int(claim_id), int(sent_id), float(score)
-            evid = (page, sent_id, sent)
-            bisect.insort(weighted_claim_evidence[claim_id], (-score, evid))
-            if len(weighted_claim_evidence[claim_id]) > max_sentences_per_claim:
-                weighted_claim_evidence[claim_id].pop()
-    for claim_id in weighted_claim_evidence:
-        for i, (score, evid) in enumerate(weighted_claim_evidence[claim_id]):
-            weighted_claim_evidence[claim_id][i] = (-score, evid)
-    return weighted_claim_evidence
-
-
-def main(scores_file, in_file, out_file, max_sentences_per_claim=None):
+
+def get_best_evidence(scores_file, max_sentences_per_claim, sentences_file=None, predictions_file=None):
+    if scores_file is not None:
+        nlines = count_lines(scores_file)
+        lines = iter_tsv(scores_file)
+    else:
+        nlines = count_rows(sentences_file)
+        lines = iter_predicted_rows(sentences_file, predictions_file)
+    return select_best_evidence(tqdm(lines, desc="Score", total=nlines), max_sentences_per_claim)
+
+
+def main(scores_file, in_file, out_file, max_sentences_per_claim=None, sentences_file=None, predictions_file=None):
     path = os.getcwd()
-    scores_file = os.path.join(path, scores_file)
+    if scores_file is not None:
+        scores_file = os.path.join(path, scores_file)
+    else:
+        sentences_file = os.path.join(path, sentences_file)
+        predictions_file = os.path.join(path, predictions_file)
     in_file = os.path.join(path, in_file)
     out_file = os.path.join(path, out_file)
 
-    best_evidence = get_best_evidence(scores_file, max_sentences_per_claim)
+    best_evidence = get_best_evidence(scores_file, max_sentences_per_claim, sentences_file, predictions_file)
 
-    with open(out_file, "w+") as fout:
-        with open(in_file, "r") as fin:
-            nlines = reduce(lambda a, b: a + b, map(lambda x: 1, fin.readlines()), 0)
-            fin.seek(0)
-            lines = map(json.loads, fin.readlines())
-            for line in tqdm(lines, desc="Claim", total=nlines):
-                claim_id = line["id"]
-                line["predicted_sentences"] = best_evidence[claim_id]
-                fout.write(json.dumps(line) + "\n")
+    write_predicted_sentences(in_file, out_file, best_evidence)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--scores-file", type=str)
+    parser.add_argument("--scores-file", type=str,
+                        help="tsv file of the sentences to select from, each followed by its score")
+    parser.add_argument("--sentences-file", type=str,
+                        help="sentences to select from, as a tsv file or a directory of columns, when no scores file is given")
+    parser.add_argument("--predictions-file", type=str,
+                        help="scores of the sentences of the sentences file, one per line")
     parser.add_argument("--in-file", type=str, help="input dataset")
     parser.add_argument("--out-file", type=str,
                         help="path to save output dataset")
     parser.add_argument("--max-sentences-per-claim", type=int,
                         help="number of top sentences to return for each claim")
     args = parser.parse_args()
-    main(args.scores_file, args.in_file, args.out_file, max_sentences_per_claim=args.max_sentences_per_claim)
+    main(args.scores_file, args.in_file, args.out_file, max_sentences_per_claim=args.max_sentences_per_claim,
+         sentences_file=args.sentences_file, predictions_file=args.predictions_file)
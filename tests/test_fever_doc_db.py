@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from common.fever_doc_db import FeverDocDB
+
+
+NUM_DOCS = 500
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "docs.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE documents (id PRIMARY KEY, lines)")
+    connection.execute("CREATE TABLE sentences (page_id, sent_id, text)")
+    for i in range(NUM_DOCS):
+        connection.execute("INSERT INTO documents VALUES (?,?)", ("Doc_%d" % i, "0\tFirst %d\n1\tSecond %d" % (i, i)))
+        connection.executemany("INSERT INTO sentences VALUES (?,?,?)",
+                               [("Doc_%d" % i, 0, "First %d" % i), ("Doc_%d" % i, 1, "Second %d" % i)])
+    connection.commit()
+    connection.close()
+    return path
+
+
+def doc_ids(start, end):
+    return ["Doc_%d" % i for i in range(start, end)] + ["Missing_%d" % i for i in range(start, end)]
+
+
+def expected_lines(start, end):
+    return {"Doc_%d" % i: "0\tFirst %d\n1\tSecond %d" % (i, i) for i in range(start, end)}
+
+
+@pytest.mark.parametrize("read_only", [False, True])
+def test_interleaved_temp_table_queries(db_path, read_only):
+    with FeverDocDB(db_path, read_only=read_only) as db:
+        lines = db.iter_doc_lines(doc_ids(0, 300), join_threshold=100)
+        sentences = db.iter_doc_sentences(doc_ids(200, 500), join_threshold=100)
+        small = db.iter_doc_lines(doc_ids(0, 50), join_threshold=100)
+        results = {"lines": {}, "sentences": {}, "small": {}}
+        # The shortest generator comes first, so that zip does not drop items.
+        for small_pair, (doc_id, doc_lines), (page_id, doc_sentences) in zip(small, lines, sentences):
+            results["small"][small_pair[0]] = small_pair[1]
+            results["lines"][doc_id] = doc_lines
+            results["sentences"][page_id] = doc_sentences
+        results["lines"].update(lines)
+        results["sentences"].update(sentences)
+        assert results["lines"] == expected_lines(0, 300)
+        assert results["small"] == expected_lines(0, 50)
+        assert results["sentences"] == {
+            "Doc_%d" % i: [(0, "First %d" % i), (1, "Second %d" % i)] for i in range(200, 500)
+        }
+        # An abandoned generator does not prevent further queries.
+        abandoned = db.iter_doc_lines(doc_ids(0, 300), join_threshold=100)
+        next(abandoned)
+        assert dict(db.iter_doc_lines(doc_ids(100, 400), join_threshold=100)) == expected_lines(100, 400)
+        abandoned.close()
+
+
+@pytest.mark.parametrize("read_only", [False, True])
+def test_concurrent_temp_table_queries(db_path, read_only):
+    errors = []
+    results = {}
+
+    def fetch(db, n):
+        try:
+            for _ in range(10):
+                start = (n * 100) % 300
+                results[n] = dict(db.iter_doc_lines(doc_ids(start, start + 200), join_threshold=100))
+                assert results[n] == expected_lines(start, start + 200)
+        except Exception as e:
+            errors.append(e)
+
+    with FeverDocDB(db_path, read_only=read_only) as db:
+        threads = [threading.Thread(target=fetch, args=(db, n)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert errors == []
+    assert len(results) == 4
+
+
+@pytest.mark.parametrize("read_only", [False, True])
+def test_concurrent_title_index_build(db_path, read_only, monkeypatch):
+    get_doc_ids = FeverDocDB.get_doc_ids
+    builds = []
+
+    def slow_get_doc_ids(self):
+        builds.append(threading.get_ident())
+        # Give the other threads the time to also need the titles.
+        time.sleep(0.05)
+        return get_doc_ids(self)
+
+    monkeypatch.setattr(FeverDocDB, "get_doc_ids", slow_get_doc_ids)
+    errors = []
+    results = []
+    barrier = threading.Barrier(4)
+
+    def check(db, n):
+        try:
+            barrier.wait()
+            results.append((db.has_doc("Doc_%d" % n), db.has_doc("Missing_%d" % n)))
+        except Exception as e:
+            errors.append(e)
+
+    with FeverDocDB(db_path, title_index=True, read_only=read_only) as db:
+        threads = [threading.Thread(target=check, args=(db, n)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert errors == []
+    assert results == [(True, False)] * 4
+    # The titles are built once, by a single thread.
+    assert len(builds) == 1
+    with FeverDocDB(db_path, title_index=True) as db:
+        assert len(db.get_titles()) == NUM_DOCS
+
+
+def test_stale_titles_are_rebuilt(db_path):
+    with FeverDocDB(db_path, title_index=True) as db:
+        assert not db.has_doc("New_doc")
+    connection = sqlite3.connect(db_path)
+    connection.execute("INSERT INTO documents VALUES (?,?)", ("New_doc", "0\tNew"))
+    connection.commit()
+    connection.close()
+    with FeverDocDB(db_path, title_index=True) as db:
+        assert db.has_doc("New_doc")
+        assert len(db.get_titles()) == NUM_DOCS + 1
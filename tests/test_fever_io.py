@@ -0,0 +1,25 @@
+import pytest
+
+from common.fever_io import iter_predicted_rows, zip_equal
+
+
+def test_zip_equal():
+    assert list(zip_equal([1, 2], "ab")) == [(1, "a"), (2, "b")]
+    with pytest.raises(ValueError, match="lengths"):
+        list(zip_equal([1, 2], "a"))
+    with pytest.raises(ValueError, match="lengths"):
+        list(zip_equal([1], "ab"))
+
+
+def test_iter_predicted_rows_lengths(tmp_path):
+    rows = tmp_path / "rows.tsv"
+    rows.write_text("1\tclaim\tpage\t0\tsentence\n1\tclaim\tpage\t1\tother\n")
+    predictions = tmp_path / "predictions.txt"
+    predictions.write_text("0.5\n0.25\n")
+    assert [row[-1] for row in iter_predicted_rows(str(rows), str(predictions))] == ["0.5", "0.25"]
+    predictions.write_text("0.5\n")
+    with pytest.raises(ValueError):
+        list(iter_predicted_rows(str(rows), str(predictions)))
+    predictions.write_text("0.5\n0.25\n0.125\n")
+    with pytest.raises(ValueError):
+        list(iter_predicted_rows(str(rows), str(predictions)))
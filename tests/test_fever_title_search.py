@@ -0,0 +1,51 @@
+import os
+import sqlite3
+
+import pytest
+
+from common import fever_title_search
+from common.fever_doc_db import FeverDocDB
+from common.fever_title_search import FeverTitleSearch, TitleStemsDB
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "docs.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE documents (id PRIMARY KEY, lines)")
+    connection.executemany("INSERT INTO documents VALUES (?,?)",
+                           [("Savages_-LRB-band-RRB-", "0\tA band"), ("Barack_Obama", "0\tA president")])
+    connection.commit()
+    connection.close()
+    return path
+
+
+def add_doc(db_path, doc_id):
+    connection = sqlite3.connect(db_path)
+    connection.execute("INSERT INTO documents VALUES (?,?)", (doc_id, "0\tNew"))
+    connection.commit()
+    connection.close()
+
+
+def test_stale_title_index_is_rebuilt(db_path):
+    assert FeverTitleSearch.from_db(db_path).search("Michelle Obama") == ["Barack Obama"]
+    add_doc(db_path, "Michelle_Obama")
+    assert FeverTitleSearch.from_db(db_path).search("Michelle Obama")[0] == "Michelle Obama"
+
+
+def test_stale_title_stems_are_detected(db_path, monkeypatch):
+    # Split the titles instead of stemming them, which needs the nltk data.
+    monkeypatch.setattr(fever_title_search, "stem_titles",
+                        lambda doc_ids: [(doc_id, " ".join(doc_id.lower().split("_"))) for doc_id in doc_ids])
+    stems_path = TitleStemsDB.default_path(db_path)
+    with FeverDocDB(db_path) as db:
+        TitleStemsDB.build(db, stems_path)
+    assert TitleStemsDB.is_current(stems_path, db_path)
+    add_doc(db_path, "Michelle_Obama")
+    assert not TitleStemsDB.is_current(stems_path, db_path)
+    with FeverDocDB(db_path) as db:
+        TitleStemsDB.build(db, stems_path)
+    assert TitleStemsDB.is_current(stems_path, db_path)
+    with TitleStemsDB(stems_path) as stems:
+        assert stems.get_stems("Michelle_Obama") == ["michelle", "obama"]
+    assert not os.path.exists(stems_path + ".tmp")